@@ -0,0 +1,447 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+import time
+
+import xarray as xr
+
+from synthetic_data import GRID_SIZES, make_synthetic_data
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / "src"))
+
+from calc_mean_temperatures import _calc_mean_temperature  # noqa: E402
+from figure_data_functions import (  # noqa: E402
+    make_change_example_plot_data,
+    make_location_example_plot_data,
+    make_location_time_series_data,
+    make_multi_window_mean_plot_data,
+    make_temperature_time_series_plot_data,
+)
+from inputs import EPI_MODEL_NAME  # noqa: E402
+import location_index  # noqa: E402
+from run_epi_model import (  # noqa: E402
+    _open_climate_data,
+    _run_yearly_portion_suitable,
+)
+
+# Benchmarks of each pipeline stage on synthetic data (see synthetic_data.py). Each
+# stage runs in a fresh process, and is reported with its wall time, throughput
+# (grid-cell-days of climate data processed or represented by the stage's inputs, per
+# second; grid cells for the map render) and increase in peak resident memory. Results
+# can be saved as a baseline, and are compared against the saved baseline (for the same
+# configuration) to flag regressions. The disk caches of the stages are kept in the
+# work directory, so that benchmarks neither use nor modify those under results/.
+
+BASELINE_PATH = pathlib.Path(__file__).parent / "baseline.json"
+REGRESSION_TOLERANCE = 0.2
+BEFORE_START_YEAR = 2025
+AFTER_START_YEAR = 2035
+LOCATIONS = {
+    "London": (51.5, -0.1),
+    "Seattle": (47.6, -122.3),
+    "Cape Town": (-33.9, 18.4),
+    "Santiago de Chile": (-33.4, -70.7),
+}
+
+
+def _run_benchmarks(config, work_dir, baseline_path=BASELINE_PATH, tolerance=None):
+    work_dir = pathlib.Path(work_dir)
+    print(f"Generating synthetic data in {work_dir}...")
+    for scenario, years in _get_years(config).items():
+        make_synthetic_data(
+            _get_data_dir(work_dir, scenario),
+            grid=config["grid"],
+            scenario=scenario,
+            years=years,
+            realizations=list(range(config["realizations"])),
+            grid_scale=config["grid_scale"],
+            seed=config["seed"],
+        )
+    results = {}
+    for stage_name in _STAGES:
+        print(f"Running {stage_name}...")
+        # A fresh process per stage, so that peak memory is measured per stage. Setup
+        # (e.g. warming disk caches) runs in a process of its own, since peak resident
+        # memory is a high-water mark that it would otherwise raise.
+        if stage_name in _STAGE_SETUP:
+            _run_in_new_process(_run_stage_setup, stage_name, str(work_dir), config)
+        results[stage_name] = _run_in_new_process(
+            _run_stage, stage_name, str(work_dir), config
+        )
+    regressions = _report(
+        results, config, baseline_path=baseline_path, tolerance=tolerance
+    )
+    return results, regressions
+
+
+def _run_in_new_process(fn, *args):
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def _run_stage_setup(stage_name, work_dir, config):
+    work_dir = pathlib.Path(work_dir)
+    location_index.INDEX_DIR = work_dir / "cache/location_index"
+    _STAGE_SETUP[stage_name](work_dir, config)
+
+
+def _run_stage(stage_name, work_dir, config):
+    work_dir = pathlib.Path(work_dir)
+    location_index.INDEX_DIR = work_dir / "cache/location_index"
+    max_rss_before = _get_max_rss_mb()
+    start = time.perf_counter()
+    cell_days = _STAGES[stage_name](work_dir, config)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "throughput": cell_days / seconds,
+        "peak_mem_mb": max(_get_max_rss_mb() - max_rss_before, 0),
+    }
+
+
+def _calc_mean_temperatures_stage(work_dir, config):
+    for scenario in ["control", "feedback"]:
+        save_dir = work_dir / f"mean_temperatures/{scenario}"
+        save_dir.mkdir(parents=True, exist_ok=True)
+        for path in sorted(_get_data_dir(work_dir, scenario).glob("*.nc")):
+            _calc_mean_temperature(_open_climate_data(path)).to_netcdf(
+                save_dir / path.name
+            )
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _run_epi_model_climepi_stage(work_dir, config):
+    # Results are saved for the figure data stages
+    for scenario in ["control", "feedback"]:
+        save_dir = work_dir / f"epi/{scenario}"
+        save_dir.mkdir(parents=True, exist_ok=True)
+        for path in sorted(_get_data_dir(work_dir, scenario).glob("*.nc")):
+            _run_yearly_portion_suitable(
+                _open_climate_data(path), epi_model_name=EPI_MODEL_NAME
+            ).to_netcdf(save_dir / path.name)
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _run_epi_model_lookup_stage(work_dir, config):
+    for scenario in ["control", "feedback"]:
+        for path in sorted(_get_data_dir(work_dir, scenario).glob("*.nc")):
+            _run_yearly_portion_suitable(
+                _open_climate_data(path), epi_model_name=EPI_MODEL_NAME, engine="lookup"
+            ).compute()
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _temperature_time_series_stage(work_dir, config):
+    make_temperature_time_series_plot_data(
+        ds_control_mean_temperatures=_open_results(
+            work_dir / "mean_temperatures/control"
+        ),
+        ds_feedback_mean_temperatures=_open_results(
+            work_dir / "mean_temperatures/feedback"
+        ),
+        save_path=_get_figure_data_dir(work_dir) / "temperature_time_series.nc",
+    )
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _mean_stage(work_dir, config):
+    before_years, after_years = _get_windows(config)
+    make_multi_window_mean_plot_data(
+        ds_control=_open_results(work_dir / "epi/control"),
+        ds_feedback=_open_results(work_dir / "epi/feedback"),
+        windows=[(before_years, after_years), (before_years, None)],
+        save_paths=[
+            _get_figure_data_dir(work_dir) / "mean.nc",
+            _get_figure_data_dir(work_dir) / "current.nc",
+        ],
+        ensemble_spread=True,
+    )
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _significance_stage(work_dir, config):
+    before_years, after_years = _get_windows(config)
+    make_multi_window_mean_plot_data(
+        ds_control=_open_results(work_dir / "epi/control"),
+        ds_feedback=_open_results(work_dir / "epi/feedback"),
+        windows=[(before_years, after_years)],
+        save_paths=[_get_figure_data_dir(work_dir) / "mean_significance.nc"],
+        significance=True,
+    )
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _change_example_stage(work_dir, config):
+    before_years, after_years = _get_windows(config)
+    make_change_example_plot_data(
+        ds_control=_open_results(work_dir / "epi/control"),
+        ds_feedback=_open_results(work_dir / "epi/feedback"),
+        before_years=before_years,
+        after_years=after_years,
+        realizations=list(range(config["realizations"])),
+        save_path=_get_figure_data_dir(work_dir) / "change_example.nc",
+    )
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _location_example_stage(work_dir, config):
+    before_years, after_years = _get_windows(config)
+    make_location_example_plot_data(
+        ds_control=_open_results(work_dir / "epi/control"),
+        ds_feedback=_open_results(work_dir / "epi/feedback"),
+        locations=LOCATIONS,
+        before_years=before_years,
+        after_years=after_years,
+        save_path=_get_figure_data_dir(work_dir) / "location.nc",
+    )
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _location_time_series_stage(work_dir, config):
+    make_location_time_series_data(
+        ds_control=_open_results(work_dir / "epi/control"),
+        ds_feedback=_open_results(work_dir / "epi/feedback"),
+        locations=LOCATIONS,
+        save_path=_get_figure_data_dir(work_dir) / "location_time_series.nc",
+    )
+    return _get_cell_days(config, scenarios=["control", "feedback"])
+
+
+def _warm_up_map_plot(work_dir, config):
+    # The first render builds the disk-cached raster mapping and feature layers, so
+    # the timed render (in a new process) loads them, as when re-rendering panels
+    _map_plot_stage(work_dir, config, save_name="map_warm_up.svg")
+
+
+def _map_plot_stage(work_dir, config, save_name="map.svg"):
+    # Imported here, as the plotting stack is only needed for this stage
+    import feature_layers
+    import map_raster_cache
+    import plotting_functions
+
+    feature_layers.CACHE_DIR = work_dir / "cache/feature_cache"
+    map_raster_cache.CACHE_DIR = work_dir / "cache/map_raster_cache"
+    plotting_functions.set_render_backend(config["backend"])
+    save_dir = work_dir / "figures"
+    save_dir.mkdir(parents=True, exist_ok=True)
+    with xr.open_dataset(_get_figure_data_dir(work_dir) / "mean.nc") as ds:
+        plot = plotting_functions._make_map_plot(ds.load(), "before")
+    plotting_functions._save_fig(plot, save_path=save_dir / save_name)
+    return _get_n_cells(config)
+
+
+_STAGES = {
+    "calc_mean_temperatures": _calc_mean_temperatures_stage,
+    "run_epi_model_climepi": _run_epi_model_climepi_stage,
+    "run_epi_model_lookup": _run_epi_model_lookup_stage,
+    "figure_data_temperature_time_series": _temperature_time_series_stage,
+    "figure_data_mean": _mean_stage,
+    "figure_data_significance": _significance_stage,
+    "figure_data_change_example": _change_example_stage,
+    "figure_data_location_example": _location_example_stage,
+    "figure_data_location_time_series": _location_time_series_stage,
+    "map_plot": _map_plot_stage,
+}
+_STAGE_SETUP = {"map_plot": _warm_up_map_plot}
+
+
+def _report(results, config, baseline_path=BASELINE_PATH, tolerance=None):
+    # Prints the results (with ratios to the baseline, if any) and returns the names of
+    # stages whose time or peak memory exceeds the baseline by more than the tolerance
+    if tolerance is None:
+        tolerance = REGRESSION_TOLERANCE
+    baseline = None
+    if baseline_path is not None and pathlib.Path(baseline_path).exists():
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(
+                f"Baseline configuration {baseline['config']} differs from {config}; "
+                "not comparing."
+            )
+            baseline = None
+    regressions = []
+    print(
+        f"{'stage':<38}{'time (s)':>10}{'cell-days/s':>14}{'peak MB':>10}"
+        + (f"{'time x':>9}{'mem x':>9}" if baseline is not None else "")
+    )
+    for stage_name, result in results.items():
+        line = (
+            f"{stage_name:<38}{result['seconds']:>10.3g}{result['throughput']:>14.3g}"
+            f"{result['peak_mem_mb']:>10.0f}"
+        )
+        if baseline is not None and stage_name in baseline["results"]:
+            result_baseline = baseline["results"][stage_name]
+            time_ratio = result["seconds"] / result_baseline["seconds"]
+            # Memory increases of under 1 MB are not meaningful
+            mem_ratio = max(result["peak_mem_mb"], 1) / max(
+                result_baseline["peak_mem_mb"], 1
+            )
+            line += f"{time_ratio:>9.2f}{mem_ratio:>9.2f}"
+            if time_ratio > 1 + tolerance or mem_ratio > 1 + tolerance:
+                line += "  REGRESSION"
+                regressions.append(stage_name)
+        print(line)
+    return regressions
+
+
+def _save_baseline(results, config, baseline_path=BASELINE_PATH):
+    with open(baseline_path, "w", encoding="utf-8") as f:
+        json.dump({"config": config, "results": results}, f, indent=1)
+    print(f"Saved baseline to {baseline_path}")
+
+
+def _get_max_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return float("nan")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and kilobytes on Linux
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def _open_results(result_dir):
+    return xr.open_mfdataset(
+        str(result_dir / "*.nc"),
+        chunks={},
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    )
+
+
+def _get_windows(config):
+    years_per_window = config["years_per_window"]
+    return (
+        range(BEFORE_START_YEAR, BEFORE_START_YEAR + years_per_window),
+        range(AFTER_START_YEAR, AFTER_START_YEAR + years_per_window),
+    )
+
+
+def _get_years(config):
+    # As for the real data, the feedback scenario only covers the "after" years
+    before_years, after_years = _get_windows(config)
+    return {
+        "control": [*before_years, *after_years],
+        "feedback": list(after_years),
+    }
+
+
+def _get_n_cells(config):
+    n_lat, n_lon = (
+        max(round(size * config["grid_scale"]), 2)
+        for size in GRID_SIZES[config["grid"]]
+    )
+    return n_lat * n_lon
+
+
+def _get_cell_days(config, scenarios):
+    years = _get_years(config)
+    n_years = sum(len(years[scenario]) for scenario in scenarios)
+    n_files = config["realizations"] * n_years
+    return _get_n_cells(config) * 365 * n_files
+
+
+def _get_data_dir(work_dir, scenario):
+    return pathlib.Path(work_dir) / f"data/{scenario}"
+
+
+def _get_figure_data_dir(work_dir):
+    figure_data_dir = pathlib.Path(work_dir) / "figure_data"
+    figure_data_dir.mkdir(parents=True, exist_ok=True)
+    return figure_data_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark pipeline stages on synthetic data"
+    )
+    parser.add_argument(
+        "--grid",
+        type=str,
+        choices=list(GRID_SIZES),
+        default="native",
+        help="Grid of the synthetic data (as for the native or downscaled datasets)",
+    )
+    parser.add_argument(
+        "--grid-scale",
+        type=float,
+        default=1,
+        help="Scale factor for the number of grid cells along each axis",
+    )
+    parser.add_argument(
+        "--realizations",
+        type=int,
+        default=5,
+        help="Number of realizations (at least 5, as used by the location example)",
+    )
+    parser.add_argument(
+        "--years-per-window",
+        type=int,
+        default=2,
+        help="Number of years in each of the before and after windows (at least 2, for "
+        "the location example trends)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["bokeh", "matplotlib"],
+        default="matplotlib",
+        help="Rendering backend for the map plot (bokeh requires a headless browser)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default=None,
+        help="Directory for synthetic data and outputs (by default a temporary "
+        "directory, removed afterwards)",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=str(BASELINE_PATH),
+        help="Baseline results file to compare against (or save to)",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=REGRESSION_TOLERANCE,
+        help="Relative increase in time or peak memory reported as a regression",
+    )
+    args = parser.parse_args()
+    if args.realizations < 5 or args.years_per_window < 2:
+        parser.error(
+            "--realizations must be at least 5 and --years-per-window at least 2"
+        )
+    benchmark_config = {
+        "grid": args.grid,
+        "grid_scale": args.grid_scale,
+        "realizations": args.realizations,
+        "years_per_window": args.years_per_window,
+        "seed": args.seed,
+        "backend": args.backend,
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmark_results, benchmark_regressions = _run_benchmarks(
+            benchmark_config,
+            work_dir=args.work_dir or tmp_dir,
+            baseline_path=None if args.save_baseline else args.baseline,
+            tolerance=args.tolerance,
+        )
+    if args.save_baseline:
+        _save_baseline(benchmark_results, benchmark_config, baseline_path=args.baseline)
+    elif benchmark_regressions:
+        sys.exit(f"Regressions in: {', '.join(benchmark_regressions)}")
@@ -0,0 +1,152 @@
+import pathlib
+import sys
+
+import cftime
+import dask.array
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / "src"))
+
+from data_index import _file_pattern  # noqa: E402
+
+# Synthetic daily temperature data for benchmarking, with the file layout, variables and
+# encoding (noleap calendar, time_bnds, lat/lon bounds) of the raw climate data that the
+# pipeline reads. Temperatures have a latitudinal gradient, a seasonal cycle, a warming
+# trend and day-to-day noise, so that the epi models see a realistic mix of suitable and
+# unsuitable days. Data are generated lazily in blocks of GENERATE_DAYS_PER_CHUNK days,
+# so files larger than memory can be written.
+
+# (lat, lon) grid sizes; the native size is that of the CESM2 grid used by ARISE, and
+# the downscaled size is that of a 0.25° global grid
+GRID_SIZES = {"native": (192, 288), "downscaled": (720, 1440)}
+# Longitude ranges; the native (CESM2) data use longitudes from 0 to 360
+LON_RANGES = {"native": (0, 360), "downscaled": (-180, 180)}
+SCENARIOS = {"control": "ssp245", "feedback": "sai15"}
+GENERATE_DAYS_PER_CHUNK = 73
+TIME_UNITS = "days since 1850-01-01 00:00:00"
+TIME_CALENDAR = "noleap"
+DAYS_PER_YEAR = 365
+
+
+def make_synthetic_data(
+    save_dir,
+    grid="native",
+    scenario="control",
+    years=None,
+    realizations=None,
+    grid_scale=1,
+    seed=0,
+):
+    """Write one synthetic daily temperature file per realization and year.
+
+    Files are named as for the "arise_{scenario}" (or, for the downscaled grid,
+    "arise_{scenario}_downscaled") dataset. grid_scale scales the number of grid cells
+    along each axis. Returns the paths of the written files, keyed by (realization,
+    year).
+    """
+    if years is None or realizations is None:
+        raise ValueError("years and realizations must be specified.")
+    save_dir = pathlib.Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    dataset = f"arise_{scenario}{'_downscaled' if grid == 'downscaled' else ''}"
+    n_lat, n_lon = (max(round(size * grid_scale), 2) for size in GRID_SIZES[grid])
+    paths = {}
+    for realization in realizations:
+        for year in years:
+            ds = make_synthetic_dataset(
+                n_lat=n_lat,
+                n_lon=n_lon,
+                lon_range=LON_RANGES[grid],
+                year=year,
+                realization=realization,
+                scenario=scenario,
+                seed=seed,
+            )
+            # Same names as the raw data, so that data_index patterns match
+            path = save_dir / _file_pattern(
+                dataset, realization=realization, year=year
+            ).replace("*", "synthetic")
+            ds.to_netcdf(
+                path,
+                encoding={
+                    "temperature": {"dtype": "float32"},
+                    "time": {"units": TIME_UNITS, "calendar": TIME_CALENDAR},
+                    "time_bnds": {"units": TIME_UNITS, "calendar": TIME_CALENDAR},
+                },
+            )
+            paths[(realization, year)] = path
+    return paths
+
+
+def make_synthetic_dataset(
+    n_lat=None,
+    n_lon=None,
+    lon_range=LON_RANGES["native"],
+    year=None,
+    realization=0,
+    scenario="control",
+    seed=0,
+):
+    lat_bnds = np.linspace(-90, 90, n_lat + 1)
+    lon_bnds = np.linspace(*lon_range, n_lon + 1)
+    lat = (lat_bnds[:-1] + lat_bnds[1:]) / 2
+    lon = (lon_bnds[:-1] + lon_bnds[1:]) / 2
+    day_starts = [
+        cftime.DatetimeNoLeap(year, 1, 1) + np.timedelta64(day, "D").item()
+        for day in range(DAYS_PER_YEAR + 1)
+    ]
+    time_bnds = np.array([day_starts[:-1], day_starts[1:]]).T
+    time = np.array(
+        [start + (end - start) / 2 for start, end in zip(*time_bnds.T)], dtype=object
+    )
+
+    # Mean temperature (°C) by latitude, with a seasonal cycle of opposite sign in
+    # each hemisphere, a warming trend and (for the intervention scenario) cooling
+    da_lat = xr.DataArray(lat, dims="lat")
+    da_day = xr.DataArray(np.arange(DAYS_PER_YEAR), dims="time")
+    da_mean = (
+        28
+        - 45 * (np.abs(da_lat) / 90) ** 2
+        + 12 * (da_lat / 90) * np.sin(2 * np.pi * (da_day - 105) / DAYS_PER_YEAR)
+        + 0.03 * (year - 2015)
+        - (0.5 if scenario == "feedback" else 0)
+    ).astype(np.float32)
+    # Fixed longitudinal structure (e.g. land-sea contrast) and day-to-day noise
+    rng = np.random.default_rng([seed, 0])
+    da_lon_pattern = xr.DataArray(
+        (2 * np.sin(np.radians(lon) * 3 + rng.uniform(0, 2 * np.pi))).astype(
+            np.float32
+        ),
+        dims="lon",
+    )
+    noise = dask.array.random.default_rng(
+        [seed, realization, year, list(SCENARIOS).index(scenario)]
+    ).standard_normal(
+        (DAYS_PER_YEAR, n_lat, n_lon),
+        chunks=(GENERATE_DAYS_PER_CHUNK, -1, -1),
+        dtype=np.float32,
+    )
+    da_temperature = (
+        da_mean + da_lon_pattern + 3 * xr.DataArray(noise, dims=["time", "lat", "lon"])
+    ).transpose("time", "lat", "lon")
+
+    ds = xr.Dataset(
+        {
+            "temperature": da_temperature.expand_dims(
+                realization=[realization], scenario=[SCENARIOS[scenario]]
+            ).assign_attrs(long_name="Temperature", units="°C"),
+            "time_bnds": (("time", "bnds"), time_bnds),
+            "lat_bnds": (("lat", "bnds"), np.array([lat_bnds[:-1], lat_bnds[1:]]).T),
+            "lon_bnds": (("lon", "bnds"), np.array([lon_bnds[:-1], lon_bnds[1:]]).T),
+        },
+        coords={"time": time, "lat": lat, "lon": lon},
+    )
+    ds["time"].attrs.update(bounds="time_bnds", axis="T")
+    ds["lat"].attrs.update(
+        bounds="lat_bnds", axis="Y", units="degrees_north", standard_name="latitude"
+    )
+    ds["lon"].attrs.update(
+        bounds="lon_bnds", axis="X", units="degrees_east", standard_name="longitude"
+    )
+    return ds
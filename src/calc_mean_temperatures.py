@@ -1,21 +1,25 @@
 import argparse
+import functools
 import itertools
 import pathlib
 
 import climepi  # noqa
 import numpy as np
-import xarray as xr
 import xcdat.spatial  # noqa
-from tqdm import tqdm
 
 from inputs import DATASETS
-from run_epi_model import _data_path
+from parallel_utils import atomic_save_paths, run_tasks
+from run_epi_model import _data_path, _estimate_mem_mb, _open_climate_data
+
+# Approximate peak memory use when averaging a file, as a multiple of its decoded size
+MEAN_TEMPERATURE_MEM_OVERHEAD = 2
 
 
 def _calc_mean_temperatures(
     dataset=None,
     years=None,
     realizations=None,
+    workers=1,
 ):
     subset_all = DATASETS[dataset]["subset"]
     if years is None:
@@ -25,25 +29,46 @@ def _calc_mean_temperatures(
     years = np.atleast_1d(years)
     realizations = np.atleast_1d(realizations)
 
+    save_dir = _get_mean_temperature_save_dir(dataset)
+
+    run_tasks(
+        functools.partial(
+            _calc_mean_temperature_file, dataset=dataset, save_dir=save_dir
+        ),
+        [
+            {"realization": realization, "year": year}
+            for year, realization in itertools.product(years, realizations)
+        ],
+        workers=workers,
+        task_mem_mb=_estimate_mem_mb(
+            _data_path(dataset=dataset, realization=realizations[0], year=years[0]),
+            overhead_factor=MEAN_TEMPERATURE_MEM_OVERHEAD,
+        ),
+    )
+
+
+def _calc_mean_temperature_file(*, dataset, realization, year, save_dir):
+    data_path = _data_path(dataset=dataset, realization=realization, year=year)
+    ds_clim = _open_climate_data(data_path)
+    ds_mean = _calc_mean_temperature(ds_clim)
+    with atomic_save_paths([save_dir / f"{realization}_{year}.nc"]) as (tmp_path,):
+        ds_mean.to_netcdf(tmp_path)
+
+
+def _calc_mean_temperature(ds_clim):
+    return _spatial_mean_temperature(ds_clim).compute().climepi.yearly_average()
+
+
+def _spatial_mean_temperature(ds_clim):
+    return ds_clim.spatial.average("temperature")[["temperature"]]
+
+
+def _get_mean_temperature_save_dir(dataset):
     save_dir = (
         pathlib.Path(__file__).parents[1] / f"results/mean_temperatures/{dataset}"
     )
     save_dir.mkdir(parents=True, exist_ok=True)
-
-    for year, realization in tqdm(
-        itertools.product(years, realizations),
-        total=len(years) * len(realizations),
-    ):
-        data_path = _data_path(dataset=dataset, realization=realization, year=year)
-        ds_clim = xr.open_dataset(data_path, chunks={})
-        ds_clim.time_bnds.load()  # Load time bounds to avoid encoding issues
-        ds_mean = (
-            ds_clim.spatial.average("temperature")[["temperature"]]
-            .compute()
-            .climepi.yearly_average()
-        )
-        save_path = save_dir / f"{realization}_{year}.nc"
-        ds_mean.to_netcdf(save_path)
+    return save_dir
 
 
 if __name__ == "__main__":
@@ -63,9 +88,16 @@ if __name__ == "__main__":
         default=None,
         help="Realizations to run the epi model on",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of files to process in parallel (capped to fit in memory)",
+    )
     args = parser.parse_args()
     _calc_mean_temperatures(
         dataset=args.dataset,
         years=args.years,
         realizations=args.realizations,
+        workers=args.workers,
     )
@@ -0,0 +1,85 @@
+import fnmatch
+import json
+import os
+import pathlib
+
+from inputs import DATASETS
+from parallel_utils import atomic_save_paths
+
+# Index of raw climate data files for each dataset, mapping (realization, year) to the
+# file name along with its size and modification time. The index is saved under
+# results/data_index, and rebuilt (with a single directory scan) whenever the
+# dataset's save_dir has been modified since the index was built.
+
+_INDEX_CACHE = {}
+
+
+def get_data_path(dataset=None, realization=None, year=None):
+    data_dir = DATASETS[dataset]["save_dir"]
+    index = load_data_index(dataset)
+    key = _index_key(realization, year)
+    if key not in index["files"]:
+        # Outside the dataset subset (or not unique), so search the directory directly
+        (path,) = data_dir.glob(
+            _file_pattern(dataset, realization=realization, year=year)
+        )
+        return path
+    return data_dir / index["files"][key]["name"]
+
+
+def load_data_index(dataset=None):
+    data_dir = DATASETS[dataset]["save_dir"]
+    dir_mtime_ns = data_dir.stat().st_mtime_ns
+    index = _INDEX_CACHE.get(dataset)
+    if index is None or index["dir_mtime_ns"] != dir_mtime_ns:
+        index_path = _get_index_path(dataset)
+        index = None
+        if index_path.exists():
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        if index is None or index["dir_mtime_ns"] != dir_mtime_ns:
+            index = _build_data_index(dataset, dir_mtime_ns=dir_mtime_ns)
+            with atomic_save_paths([index_path], shared_cache=True) as (tmp_path,):
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(index, f, indent=1)
+        _INDEX_CACHE[dataset] = index
+    return index
+
+
+def _build_data_index(dataset, dir_mtime_ns):
+    print(f"Building data index for {dataset}...")
+    data_dir = DATASETS[dataset]["save_dir"]
+    subset = DATASETS[dataset]["subset"]
+    with os.scandir(data_dir) as it:
+        entries = {entry.name: entry for entry in it if entry.is_file()}
+    files = {}
+    for realization in subset["realizations"]:
+        for year in subset["years"]:
+            names = fnmatch.filter(
+                entries, _file_pattern(dataset, realization=realization, year=year)
+            )
+            if len(names) != 1:
+                continue
+            stat = entries[names[0]].stat()
+            files[_index_key(realization, year)] = {
+                "name": names[0],
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+    return {"dir_mtime_ns": dir_mtime_ns, "files": files}
+
+
+def _file_pattern(dataset, realization, year):
+    if "downscaled" in dataset:
+        return f"{dataset}_{realization}_{year}.nc"
+    return f"*_{year}_*_{realization}.nc"
+
+
+def _index_key(realization, year):
+    return f"{int(realization)}_{int(year)}"
+
+
+def _get_index_path(dataset):
+    index_dir = pathlib.Path(__file__).parents[1] / "results/data_index"
+    index_dir.mkdir(parents=True, exist_ok=True)
+    return index_dir / f"{dataset}.json"
@@ -1,17 +1,35 @@
 import argparse
+import concurrent.futures
+import functools
+import hashlib
 import itertools
+import json
 import pathlib
+import shutil
+import time
 
 import numpy as np
+import xarray as xr
 from climepi import climdata
 from tqdm import tqdm
 
+from data_index import _file_pattern
 from inputs import DATASETS
+from parallel_utils import atomic_save_paths
 
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF_SECONDS = 30
 
-def _get_data(dataset, years=None, realizations=None):
-    kwargs_all = DATASETS[dataset]
-    subset_all = kwargs_all["subset"]
+
+def _get_data(
+    dataset,
+    years=None,
+    realizations=None,
+    workers=1,
+    source_dir=None,
+    retries=DOWNLOAD_RETRIES,
+):
+    subset_all = DATASETS[dataset]["subset"]
     if years is None:
         years = subset_all["years"]
     if realizations is None:
@@ -24,24 +42,192 @@ def _get_data(dataset, years=None, realizations=None):
     )
     download_confirmation_dir.mkdir(parents=True, exist_ok=True)
 
-    for year, realization in tqdm(
-        itertools.product(years, realizations),
-        total=len(years) * len(realizations),
-    ):
-        subset_current = {
-            **subset_all,
+    # Files are fetched by a "transport", which is climepi by default, or a copy from a
+    # local directory mirroring the remote data (e.g. for testing offline)
+    if source_dir is None:
+        fetch = _fetch_climepi
+    else:
+        fetch = functools.partial(_fetch_local, source_dir=pathlib.Path(source_dir))
+
+    pending = []
+    for year, realization in itertools.product(years, realizations):
+        if _is_verified(dataset, realization=realization, year=year):
+            print(f"Skipping verified file for realization {realization}, year {year}")
+            _write_confirmation(download_confirmation_dir, realization, year)
+        else:
+            pending.append((realization, year))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                _download_file,
+                fetch,
+                dataset=dataset,
+                realization=realization,
+                year=year,
+                retries=retries,
+            ): (realization, year)
+            for realization, year in pending
+        }
+        try:
+            for future in tqdm(
+                concurrent.futures.as_completed(futures), total=len(futures)
+            ):
+                realization, year = futures[future]
+                future.result()
+                _write_confirmation(download_confirmation_dir, realization, year)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def _download_file(fetch, *, dataset, realization, year, retries):
+    for attempt in range(retries + 1):
+        try:
+            data_path = fetch(dataset=dataset, realization=realization, year=year)
+            if data_path is not None:
+                _check_readable(data_path)
+            break
+        except Exception as exc:
+            if attempt == retries:
+                raise
+            wait = DOWNLOAD_BACKOFF_SECONDS * 2**attempt
+            print(
+                f"Download failed for realization {realization}, year {year} ({exc}); "
+                f"retrying in {wait} s"
+            )
+            time.sleep(wait)
+    if data_path is None:
+        return
+    _write_manifest_entry(dataset, realization=realization, year=year, path=data_path)
+
+
+def _fetch_climepi(*, dataset, realization, year):
+    if "downscaled" in dataset:
+        # Downscaled data not available for direct download
+        return _find_data_file(dataset, realization=realization, year=year)
+    # Files without a manifest entry (e.g. downloaded before manifests were recorded)
+    # are adopted if readable. Files that do not match their manifest entry, or are
+    # unreadable, may be partial, and since climepi skips files that already exist
+    # they are removed before downloading again.
+    existing_path = _find_data_file(dataset, realization=realization, year=year)
+    if existing_path is not None:
+        if _read_manifest_entry(dataset, realization=realization, year=year) is None:
+            try:
+                _check_readable(existing_path)
+                return existing_path
+            except Exception as exc:
+                print(f"Removing unreadable file {existing_path.name} ({exc})")
+        else:
+            print(f"Removing file {existing_path.name} not matching its manifest entry")
+        existing_path.unlink()
+    kwargs_all = DATASETS[dataset]
+    kwargs_current = {
+        **kwargs_all,
+        "subset": {
+            **kwargs_all["subset"],
             "years": [year],
             "realizations": [realization],
-        }
-        kwargs_current = {**kwargs_all, "subset": subset_current}
-        if "downscaled" not in dataset:
-            # Downscaled data not available for direct download
-            climdata.get_climate_data(**kwargs_current)
-        download_confirmation_path = (
-            download_confirmation_dir / f"{realization}_{year}.txt"
+        },
+    }
+    climdata.get_climate_data(**kwargs_current)
+    data_path = _find_data_file(dataset, realization=realization, year=year)
+    if data_path is None:
+        raise FileNotFoundError(
+            f"No data file found for realization {realization}, year {year} after "
+            "downloading."
         )
-        with open(download_confirmation_path, "w", encoding="utf-8") as f:
-            f.write("Downloaded")
+    return data_path
+
+
+def _fetch_local(*, dataset, realization, year, source_dir):
+    save_dir = DATASETS[dataset]["save_dir"]
+    (source_path,) = (source_dir / save_dir.name).glob(
+        _file_pattern(dataset, realization=realization, year=year)
+    )
+    save_dir.mkdir(parents=True, exist_ok=True)
+    with atomic_save_paths([save_dir / source_path.name]) as (tmp_path,):
+        shutil.copyfile(source_path, tmp_path)
+    return save_dir / source_path.name
+
+
+def _find_data_file(dataset, realization, year):
+    paths = list(
+        DATASETS[dataset]["save_dir"].glob(
+            _file_pattern(dataset, realization=realization, year=year)
+        )
+    )
+    if len(paths) > 1:
+        raise ValueError(f"Multiple data files found: {paths}")
+    return paths[0] if paths else None
+
+
+def _is_verified(dataset, realization, year):
+    # A file is verified if it matches its manifest entry. The hash is only recomputed
+    # if the size matches but the modification time does not.
+    entry = _read_manifest_entry(dataset, realization=realization, year=year)
+    if entry is None:
+        return False
+    path = DATASETS[dataset]["save_dir"] / entry["name"]
+    if not path.exists():
+        return False
+    stat = path.stat()
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    return _sha256(path) == entry["sha256"]
+
+
+def _check_readable(path):
+    # Truncated downloads typically fail when reading the end of the data
+    with xr.open_dataset(path) as ds:
+        ds.isel(time=-1).load()
+
+
+def _read_manifest_entry(dataset, realization, year):
+    entry_path = _get_manifest_dir(dataset) / f"{realization}_{year}.json"
+    if not entry_path.exists():
+        return None
+    with open(entry_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_manifest_entry(dataset, realization, year, path):
+    stat = path.stat()
+    entry = {
+        "name": path.name,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": _sha256(path),
+    }
+    entry_path = _get_manifest_dir(dataset) / f"{realization}_{year}.json"
+    with atomic_save_paths([entry_path]) as (tmp_path,):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, indent=1)
+
+
+def _get_manifest_dir(dataset):
+    # One entry per file, so that concurrent download jobs never write the same file
+    manifest_dir = (
+        pathlib.Path(__file__).parents[1] / "results/download_manifests" / dataset
+    )
+    manifest_dir.mkdir(parents=True, exist_ok=True)
+    return manifest_dir
+
+
+def _sha256(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**23), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _write_confirmation(download_confirmation_dir, realization, year):
+    download_confirmation_path = download_confirmation_dir / f"{realization}_{year}.txt"
+    with open(download_confirmation_path, "w", encoding="utf-8") as f:
+        f.write("Downloaded")
 
 
 if __name__ == "__main__":
@@ -57,6 +243,25 @@ if __name__ == "__main__":
         default=None,
         help="Realizations to download",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of files to download concurrently",
+    )
+    parser.add_argument(
+        "--source-dir",
+        type=str,
+        default=None,
+        help="Copy files from this directory (laid out like data/) instead of "
+        "downloading them",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DOWNLOAD_RETRIES,
+        help="Number of retries (with exponential backoff) per file",
+    )
 
     args = parser.parse_args()
 
@@ -64,4 +269,7 @@ if __name__ == "__main__":
         dataset=args.dataset,
         years=args.years,
         realizations=args.realizations,
+        workers=args.workers,
+        source_dir=args.source_dir,
+        retries=args.retries,
     )
@@ -0,0 +1,151 @@
+import pathlib
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from inputs import DATASETS, REALIZATIONS_PER_JOB, YEARS_PER_JOB
+
+# Epi model results can alternatively be written to a single Zarr store per dataset and
+# epi model, with realization and time dimensions covering the full dataset subset.
+# Chunks match the Snakemake batches (REALIZATIONS_PER_JOB x YEARS_PER_JOB), so that
+# each batch writes whole chunks and concurrent batches never touch the same chunk.
+# Small marker files record which regions have been written, for use as Snakemake
+# outputs.
+
+
+def init_epi_store(ds_epi_template, dataset=None, epi_model_name=None):
+    """Pre-allocate the Zarr store for a dataset and epi model.
+
+    ds_epi_template is the epi model output for any single year and realization, and
+    is used for the grid, variables and encoding. Metadata, coordinates and variables
+    without a realization or time dimension (e.g. grid bounds) are written; the
+    remaining data are filled in by write_epi_store_region. Any existing store for the
+    dataset and epi model is overwritten.
+    """
+    subset = DATASETS[dataset]["subset"]
+    realizations = subset["realizations"]
+    years = subset["years"]
+    ds_template = _with_realization_dim(ds_epi_template)
+    first_time = ds_template.time.values[0]
+    ds_template = ds_template.isel(
+        realization=[0] * len(realizations), time=[0] * len(years)
+    ).assign_coords(
+        realization=realizations,
+        time=[_with_year(first_time, year) for year in years],
+    )
+    # Only variables with region dimensions are chunked (as dask arrays, which
+    # to_zarr(compute=False) does not write); the rest are written now
+    chunks = {"realization": REALIZATIONS_PER_JOB, "time": YEARS_PER_JOB}
+    region_variables = {
+        name: ds_template[name].variable
+        for name in ds_template.data_vars
+        if set(chunks) & set(ds_template[name].dims)
+    }
+    ds_template = ds_template.assign(
+        {
+            name: variable.chunk(
+                {dim: size for dim, size in chunks.items() if dim in variable.dims}
+            )
+            for name, variable in region_variables.items()
+        }
+    )
+    store_path = get_epi_store_path(dataset=dataset, epi_model_name=epi_model_name)
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    marker_dir = get_epi_store_marker_dir(
+        dataset=dataset, epi_model_name=epi_model_name
+    )
+    marker_dir.mkdir(parents=True, exist_ok=True)
+    for marker_path in marker_dir.glob("*.txt"):
+        marker_path.unlink()
+    ds_template.to_zarr(store_path, mode="w", compute=False, consolidated=True)
+    with open(marker_dir / "initialized.txt", "w", encoding="utf-8") as f:
+        f.write("Initialized")
+
+
+def write_epi_store_region(datasets_epi, dataset=None, epi_model_name=None):
+    """Write epi model results into the store as a single region.
+
+    datasets_epi is a list of results (e.g. one per year and realization) that
+    together cover contiguous realizations and years. Variables without a realization
+    or time dimension (e.g. grid bounds) are already in the store, and are not written
+    again.
+    """
+    subset = DATASETS[dataset]["subset"]
+    ds_epi = xr.combine_by_coords(
+        [_with_realization_dim(ds) for ds in datasets_epi],
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        combine_attrs="override",
+    ).sortby(["realization", "time"])
+    realizations = ds_epi.realization.values.tolist()
+    years = ds_epi.time.dt.year.values.tolist()
+    region = {
+        "realization": _region_slice(realizations, subset["realizations"]),
+        "time": _region_slice(years, subset["years"]),
+    }
+    ds_epi = ds_epi.drop_vars(
+        [
+            name
+            for name, variable in ds_epi.variables.items()
+            if not set(region).intersection(variable.dims)
+        ]
+    )
+    ds_epi.to_zarr(
+        get_epi_store_path(dataset=dataset, epi_model_name=epi_model_name),
+        region=region,
+        consolidated=False,
+    )
+    marker_dir = get_epi_store_marker_dir(
+        dataset=dataset, epi_model_name=epi_model_name
+    )
+    for realization in realizations:
+        for year in years:
+            with open(
+                marker_dir / f"{realization}_{year}.txt", "w", encoding="utf-8"
+            ) as f:
+                f.write("Written")
+
+
+def open_epi_store(dataset=None, epi_model_name=None):
+    return xr.open_zarr(
+        get_epi_store_path(dataset=dataset, epi_model_name=epi_model_name),
+        consolidated=True,
+    )
+
+
+def get_epi_store_path(dataset=None, epi_model_name=None):
+    return (
+        pathlib.Path(__file__).parents[1] / f"results/{epi_model_name}/{dataset}.zarr"
+    )
+
+
+def get_epi_store_marker_dir(dataset=None, epi_model_name=None):
+    return (
+        pathlib.Path(__file__).parents[1]
+        / f"results/{epi_model_name}/{dataset}_zarr_regions"
+    )
+
+
+def _with_realization_dim(ds):
+    if "realization" in ds.dims:
+        return ds
+    if "realization" not in ds.coords:
+        raise ValueError("Epi model results must have a realization coordinate.")
+    return ds.expand_dims("realization")
+
+
+def _with_year(time_value, year):
+    if isinstance(time_value, np.datetime64):
+        return np.datetime64(pd.Timestamp(time_value).replace(year=year))
+    return time_value.replace(year=year)  # cftime datetime
+
+
+def _region_slice(values, all_values):
+    start = all_values.index(values[0])
+    if values != all_values[start : start + len(values)]:
+        raise ValueError(
+            f"Values {values} are not a contiguous run of the dataset subset."
+        )
+    return slice(start, start + len(values))
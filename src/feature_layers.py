@@ -0,0 +1,77 @@
+import hashlib
+import pathlib
+import pickle
+
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import geoviews as gv
+import shapely
+
+from parallel_utils import atomic_save_paths
+
+# Geographic feature layers drawn on map panels. Natural Earth geometries are loaded and
+# projected once per projection and detail level (scale), and the resulting layers are
+# shared by all maps made in the process. Projected geometries are also saved under
+# results/feature_cache, so later runs skip loading and projecting them.
+
+# Feature name: (Natural Earth feature, geoviews group), in drawing order
+FEATURES = {
+    "borders": (cfeature.BORDERS, "Borders"),
+    "coastline": (cfeature.COASTLINE, "Coastline"),
+    "ocean": (cfeature.OCEAN, "Ocean"),
+    "lakes": (cfeature.LAKES, "Lakes"),
+}
+CACHE_DIR = pathlib.Path(__file__).parents[1] / "results/feature_cache"
+
+_FEATURE_LAYER_CACHE = {}
+
+
+def get_feature_layers(projection=None, scale="110m"):
+    """Return a dict of geoviews Feature layers with geometries in projection."""
+    if projection is None:
+        projection = ccrs.PlateCarree()
+    key = _get_key(projection, scale=scale)
+    if key not in _FEATURE_LAYER_CACHE:
+        geometries = _load_projected_geometries(projection, scale=scale, key=key)
+        _FEATURE_LAYER_CACHE[key] = {
+            name: gv.Feature(
+                cfeature.ShapelyFeature(geometries[name], projection), group=group
+            )
+            for name, (_, group) in FEATURES.items()
+        }
+    return _FEATURE_LAYER_CACHE[key]
+
+
+def _load_projected_geometries(projection, scale, key):
+    cache_path = _get_cache_dir() / f"{key}.pkl"
+    if cache_path.exists():
+        with open(cache_path, "rb") as f:
+            geometries_wkb = pickle.load(f)
+        return {
+            name: list(shapely.from_wkb(wkb)) for name, wkb in geometries_wkb.items()
+        }
+    print(f"Projecting {scale} feature geometries...")
+    geometries = {}
+    for name, (feature, _) in FEATURES.items():
+        feature = feature.with_scale(scale)
+        projected = (
+            projection.project_geometry(geometry, feature.crs)
+            for geometry in feature.geometries()
+        )
+        geometries[name] = [geometry for geometry in projected if not geometry.is_empty]
+    with atomic_save_paths([cache_path], shared_cache=True) as (tmp_path,):
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {name: shapely.to_wkb(geoms) for name, geoms in geometries.items()}, f
+            )
+    return geometries
+
+
+def _get_key(projection, scale):
+    return hashlib.sha256(f"{projection.to_wkt()}_{scale}".encode()).hexdigest()
+
+
+def _get_cache_dir():
+    cache_dir = pathlib.Path(CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
@@ -1,20 +1,16 @@
 import climepi  # noqa
+import dask
+import numpy as np
 import xarray as xr
 
+from location_index import extract_locations
+from window_mean_cache import get_window_sums
 
-def _get_feedback_matched_before_dataset(ds_before):
-    # Create a dataset where the first 5 realizations are duplicated to match the
-    # realizations in the feedback dataset
-    return xr.concat(
-        [
-            ds_before.sel(realization=[0, 1, 2, 3, 4]),
-            ds_before.sel(realization=[0, 1, 2, 3, 4]).assign_coords(
-                realization=[5, 6, 7, 8, 9]
-            ),
-        ],
-        dim="realization",
-        data_vars="minimal",
-    )
+ENSEMBLE_PERCENTILES = [5, 50, 95]
+SIGNIFICANCE_RESAMPLES = 2000
+SIGNIFICANCE_LEVEL = 0.05
+SIGNIFICANCE_CHUNK_BYTES = 2**28  # memory for resampled differences per chunk
+WINDOW_REDUCTIONS = ["mean", "realization_mean", "std", "percentile"]
 
 
 def make_temperature_time_series_plot_data(
@@ -37,40 +33,105 @@ def make_mean_plot_data(
     after_years=range(2035, 2045),
     save_path=None,
 ):
-    ds_before = ds_control.sel(
-        time=ds_control.time.dt.year.isin(before_years)
-    ).squeeze()
-    ds_before_mean = ds_before[["portion_suitable"]].mean(dim=["time", "realization"])
-    ds_out = xr.Dataset(
-        {"before": ds_before_mean["portion_suitable"]},
-        attrs={"before_year_range": f"{before_years.start}-{before_years.stop - 1}"},
-    )
-    if after_years is None:
-        ds_out.to_netcdf(save_path)
-        return
-    ds_control_after = ds_control.sel(
-        time=ds_control.time.dt.year.isin(after_years)
-    ).squeeze()
-    ds_control_after_mean = ds_control_after[["portion_suitable"]].mean(
-        dim=["time", "realization"]
-    )
-    ds_feedback_after = ds_feedback.sel(
-        time=ds_feedback.time.dt.year.isin(after_years)
-    ).squeeze()
-    ds_feedback_after_mean = ds_feedback_after[["portion_suitable"]].mean(
-        dim=["time", "realization"]
-    )
-    ds_out = ds_out.assign(
-        without_intervention_minus_before=ds_control_after_mean["portion_suitable"]
-        - ds_before_mean["portion_suitable"],
-        with_intervention_minus_before=ds_feedback_after_mean["portion_suitable"]
-        - ds_before_mean["portion_suitable"],
-        with_minus_without_intervention=ds_feedback_after_mean["portion_suitable"]
-        - ds_control_after_mean["portion_suitable"],
-    ).assign_attrs(
-        after_year_range=f"{after_years.start}-{after_years.stop - 1}",
+    make_multi_window_mean_plot_data(
+        ds_control=ds_control,
+        ds_feedback=ds_feedback,
+        windows=[(before_years, after_years)],
+        save_paths=[save_path],
     )
-    ds_out.to_netcdf(save_path)
+
+
+def make_multi_window_mean_plot_data(
+    ds_control=None,
+    ds_feedback=None,
+    windows=None,
+    save_paths=None,
+    ensemble_spread=False,
+    significance=False,
+    significance_resamples=SIGNIFICANCE_RESAMPLES,
+    input_keys=None,
+):
+    """Make mean plot data for several (before_years, after_years) windows at once.
+
+    The outputs are comparisons (see make_comparison_data), with the window sums for
+    all outputs computed in a single pass and shared between them. after_years may be
+    None for a window, in which case only the "before" mean is saved (ds_feedback is
+    then not needed). If ensemble_spread is True, the percentiles
+    (ENSEMBLE_PERCENTILES) and standard deviation across realizations of each window
+    mean are also saved. If significance is True, a permutation test p-value (and
+    significance at SIGNIFICANCE_LEVEL) is also saved for
+    with_minus_without_intervention.
+    """
+    if windows is None or save_paths is None or len(windows) != len(save_paths):
+        raise ValueError("windows and save_paths must be specified with equal lengths.")
+    datasets = {"control": ds_control, "feedback": ds_feedback}
+    comparisons_all = []
+    for before_years, after_years in windows:
+        window_specs = {"before": {"scenario": "control", "years": before_years}}
+        comparisons = {"before": window_specs["before"]}
+        if after_years is not None:
+            window_specs.update(
+                without_intervention={"scenario": "control", "years": after_years},
+                with_intervention={"scenario": "feedback", "years": after_years},
+            )
+            comparisons.update(
+                without_intervention_minus_before=(
+                    window_specs["without_intervention"],
+                    window_specs["before"],
+                ),
+                with_intervention_minus_before=(
+                    window_specs["with_intervention"],
+                    window_specs["before"],
+                ),
+                with_minus_without_intervention=(
+                    window_specs["with_intervention"],
+                    window_specs["without_intervention"],
+                ),
+            )
+        if ensemble_spread:
+            for name, spec in window_specs.items():
+                comparisons[f"{name}_percentile"] = {**spec, "reduction": "percentile"}
+                comparisons[f"{name}_std"] = {**spec, "reduction": "std"}
+        comparisons_all.append(comparisons)
+    window_sums = _get_all_window_sums(
+        datasets,
+        [comparison for comparisons in comparisons_all for comparison in comparisons],
+        input_keys=input_keys,
+    )
+
+    window_samples = {}
+
+    def _get_window_samples(scenario, years):
+        if (scenario, years) not in window_samples:
+            window_samples[(scenario, years)] = _window_samples(
+                datasets[scenario], years
+            )
+        return window_samples[(scenario, years)]
+
+    writes = []
+    for (before_years, after_years), comparisons, save_path in zip(
+        windows, comparisons_all, save_paths
+    ):
+        ds_out = _make_comparison_dataset(window_sums, comparisons).assign_attrs(
+            before_year_range=f"{before_years.start}-{before_years.stop - 1}"
+        )
+        if after_years is not None:
+            ds_out = ds_out.assign_attrs(
+                after_year_range=f"{after_years.start}-{after_years.stop - 1}",
+            )
+        if significance and after_years is not None:
+            da_p_value = _permutation_test_p_value(
+                _get_window_samples("feedback", after_years),
+                _get_window_samples("control", after_years),
+                resamples=significance_resamples,
+            )
+            ds_out = ds_out.assign(
+                with_minus_without_intervention_p_value=da_p_value,
+                with_minus_without_intervention_significant=da_p_value
+                < SIGNIFICANCE_LEVEL,
+            )
+        writes.append(ds_out.to_netcdf(save_path, compute=False))
+    dask.compute(*writes)
 
 
 def make_change_example_plot_data(
@@ -80,29 +141,75 @@ def make_change_example_plot_data(
     after_years=range(2035, 2045),
     realizations=None,
     save_path=None,
+    input_keys=None,
 ):
     if realizations is None:
         realizations = [0, 5, 1, 6, 2, 7, 3, 8, 4, 9]
-    ds_before_feedback_matched = (
-        _get_feedback_matched_before_dataset(
-            ds_control.sel(time=ds_control.time.dt.year.isin(before_years))
-        )
-        .sel(realization=realizations)
-        .squeeze()
-    )
-    ds_feedback_after = ds_feedback.sel(
-        time=ds_feedback.time.dt.year.isin(after_years), realization=realizations
-    ).squeeze()
-    ds_mean_change = ds_feedback_after[["portion_suitable"]].mean(
-        dim="time"
-    ) - ds_before_feedback_matched[["portion_suitable"]].mean(dim="time")
-    ds_out = xr.Dataset(
-        {"mean_change": ds_mean_change["portion_suitable"]},
+    make_comparison_data(
+        datasets={"control": ds_control, "feedback": ds_feedback},
+        comparisons={
+            "mean_change": (
+                {
+                    "scenario": "feedback",
+                    "years": after_years,
+                    "realizations": realizations,
+                    "reduction": "realization_mean",
+                },
+                {
+                    # Feedback realizations 5-9 branch from control realizations 0-4
+                    "scenario": "control",
+                    "years": before_years,
+                    "realizations": {
+                        realization: realization % 5 for realization in realizations
+                    },
+                    "reduction": "realization_mean",
+                },
+            )
+        },
+        save_path=save_path,
+        input_keys=input_keys,
         attrs={
             "before_year_range": f"{before_years.start}-{before_years.stop - 1}",
             "after_year_range": f"{after_years.start}-{after_years.stop - 1}",
         },
     )
+
+
+def make_comparison_data(
+    datasets=None,
+    comparisons=None,
+    save_path=None,
+    input_keys=None,
+    attrs=None,
+):
+    """Save comparisons of window means between scenarios, windows and realizations.
+
+    datasets maps scenario names to epi model results (or partial reductions from the
+    reduction cache). comparisons maps output variable names to either a window spec,
+    or a pair of specs whose difference (first minus second) is saved. A spec is a
+    dict with keys:
+
+    - "scenario": the scenario name (a key of datasets).
+    - "years": the years in the window, or a "first-last" string (e.g. "2025-2034").
+    - "realizations" (optional): realizations to include (by default all), or a dict
+      mapping output realization labels to dataset realizations (e.g. to match
+      feedback realizations with the control realizations they branch from).
+    - "reduction" (optional): one of WINDOW_REDUCTIONS (by default "mean"). "mean" is
+      the mean over realization-years, "realization_mean" the mean for each
+      realization, and "std" and "percentile" the standard deviation and percentiles
+      (ENSEMBLE_PERCENTILES) across realizations of the realization means.
+
+    Window sums are shared between specs, and if input_keys maps scenario names to
+    input file fingerprints (see window_mean_cache.get_input_key), are also memoized
+    in process and on disk for reuse by later comparisons.
+    """
+    if comparisons is None:
+        raise ValueError("comparisons must be specified.")
+    window_sums = _get_all_window_sums(
+        datasets, list(comparisons.values()), input_keys=input_keys
+    )
+    ds_out = _make_comparison_dataset(window_sums, comparisons)
+    ds_out.attrs.update(attrs or {})
     ds_out.to_netcdf(save_path)
 
 
@@ -122,14 +229,14 @@ def make_location_example_plot_data(
         )
         .drop_vars("member_id", errors="ignore")
         .squeeze(drop=True)
-        .climepi.sel_geo(location=locations)
+        .pipe(extract_locations, locations)
     )
     ds_before = ds_before.assign(time=ds_before.time.dt.year)  # avoids plotting issues
     ds_feedback_after = (
         ds_feedback.sel(time=ds_feedback.time.dt.year.isin(after_years))
         .drop_vars("member_id", errors="ignore")
         .squeeze(drop=True)
-        .climepi.sel_geo(location=locations)
+        .pipe(extract_locations, locations)
     )
     ds_feedback_after = ds_feedback_after.assign(
         time=ds_feedback_after.time.dt.year  # avoids plotting issues
@@ -158,3 +265,180 @@ def make_location_example_plot_data(
         }
     )
     ds_out.to_netcdf(save_path)
+
+
+def make_location_time_series_data(
+    ds_control=None,
+    ds_feedback=None,
+    locations=None,
+    save_path=None,
+):
+    """Save yearly portion_suitable time series at many locations.
+
+    locations is as for location_index.extract_locations. The output is a compact
+    table with location, scenario, realization and year dimensions.
+    """
+    if locations is None:
+        raise ValueError("locations must be specified.")
+    datasets = []
+    for ds in [ds_control, ds_feedback]:
+        ds_locations = extract_locations(
+            ds[["portion_suitable"]]
+            .drop_vars(["member_id", "scenario"], errors="ignore")
+            .squeeze(drop=True),
+            locations,
+        )
+        datasets.append(
+            ds_locations.assign_coords(time=ds_locations.time.dt.year).rename(
+                time="year"
+            )
+        )
+    ds_out = xr.concat(
+        datasets,
+        dim=xr.Variable("scenario", ["control", "feedback"]),
+        join="outer",
+        coords="minimal",
+        compat="override",
+    )
+    ds_out["portion_suitable"] = ds_out["portion_suitable"].astype(np.float32)
+    ds_out.to_netcdf(save_path)
+
+
+def _get_all_window_sums(datasets, comparisons, input_keys=None):
+    # Window sums for every distinct (scenario, years) in a list of comparisons (each a
+    # spec or a pair of specs), keyed by (scenario, years tuple)
+    specs = [
+        spec
+        for comparison in comparisons
+        for spec in ([comparison] if isinstance(comparison, dict) else comparison)
+    ]
+    windows = list(
+        dict.fromkeys(
+            (spec["scenario"], tuple(_get_years(spec["years"]))) for spec in specs
+        )
+    )
+    for scenario, _ in windows:
+        if datasets.get(scenario) is None:
+            raise ValueError(f"No data provided for scenario '{scenario}'.")
+    input_keys = input_keys or {}
+    ds_sums_list = get_window_sums(
+        [
+            (datasets[scenario], years, input_keys.get(scenario))
+            for scenario, years in windows
+        ]
+    )
+    return dict(zip(windows, ds_sums_list))
+
+
+def _make_comparison_dataset(window_sums, comparisons):
+    data_vars = {}
+    for name, comparison in comparisons.items():
+        if isinstance(comparison, dict):
+            data_vars[name] = _reduce_window(window_sums, comparison)
+        else:
+            spec_1, spec_2 = comparison
+            data_vars[name] = _reduce_window(window_sums, spec_1) - _reduce_window(
+                window_sums, spec_2
+            )
+    return xr.Dataset(data_vars)
+
+
+def _reduce_window(window_sums, spec):
+    reduction = spec.get("reduction", "mean")
+    if reduction not in WINDOW_REDUCTIONS:
+        raise ValueError(
+            f"Unknown reduction '{reduction}' (expected one of {WINDOW_REDUCTIONS})."
+        )
+    ds_sums = window_sums[(spec["scenario"], tuple(_get_years(spec["years"])))]
+    realizations = spec.get("realizations")
+    # Realizations are converted to int since specs read from JSON have string keys
+    if isinstance(realizations, dict):
+        ds_sums = ds_sums.sel(
+            realization=[int(realization) for realization in realizations.values()]
+        ).assign_coords(realization=[int(label) for label in realizations])
+    elif realizations is not None:
+        ds_sums = ds_sums.sel(
+            realization=[int(realization) for realization in realizations]
+        )
+    if reduction == "mean":
+        ds_sums = ds_sums.sum(dim="realization")
+    da_mean = ds_sums["portion_suitable_sum"] / ds_sums["portion_suitable_count"]
+    if reduction == "std":
+        return da_mean.std(dim="realization", ddof=1)
+    if reduction == "percentile":
+        return (
+            da_mean.quantile(
+                [percentile / 100 for percentile in ENSEMBLE_PERCENTILES],
+                dim="realization",
+            )
+            .rename(quantile="percentile")
+            .assign_coords(percentile=ENSEMBLE_PERCENTILES)
+        )
+    return da_mean
+
+
+def _get_years(years):
+    if isinstance(years, str):
+        first, last = (int(year) for year in years.split("-"))
+        return list(range(first, last + 1))
+    return sorted(int(year) for year in years)
+
+
+def _permutation_test_p_value(da_samples_1, da_samples_2, resamples, seed=0):
+    # Two-sided permutation test for a difference in means between two sets of
+    # samples (realization-years), for every grid cell. Group assignments are drawn
+    # once and applied to the whole grid, with the resampled differences in means for
+    # each spatial chunk computed as a single matrix product.
+    n_1 = da_samples_1.sizes["sample"]
+    n_2 = da_samples_2.sizes["sample"]
+    rng = np.random.default_rng(seed)
+    in_group_1 = np.argsort(rng.random((resamples, n_1 + n_2)), axis=1) < n_1
+    weights = np.where(in_group_1, 1 / n_1, -1 / n_2)
+    observed_weights = np.concatenate([np.full(n_1, 1 / n_1), np.full(n_2, -1 / n_2)])
+    da_samples = xr.concat(
+        [da_samples_1, da_samples_2], dim="sample", coords="minimal", compat="override"
+    )
+    cells_per_lat = da_samples.size // (da_samples.sizes["lat"] * (n_1 + n_2))
+    lat_chunk = max(int(SIGNIFICANCE_CHUNK_BYTES // (8 * resamples * cells_per_lat)), 1)
+    da_p_value = xr.apply_ufunc(
+        _permutation_test_p_value_block,
+        da_samples.chunk({"sample": -1, "lat": lat_chunk}),
+        input_core_dims=[["sample"]],
+        kwargs={"weights": weights, "observed_weights": observed_weights},
+        dask="parallelized",
+        output_dtypes=[np.float64],
+    )
+    return da_p_value.assign_attrs(
+        description="Two-sided permutation test p-value for the difference in means "
+        f"(realization-years as samples, {resamples} resamples)",
+    )
+
+
+def _permutation_test_p_value_block(values, weights, observed_weights):
+    values = values.astype(np.float64)
+    observed = np.abs(values @ observed_weights)
+    resampled = np.abs(values @ weights.T)
+    # Small tolerance so that resamples equal to the observed assignment count
+    n_exceed = (resampled >= observed[..., None] * (1 - 1e-12)).sum(axis=-1)
+    p_value = (n_exceed + 1) / (weights.shape[0] + 1)
+    return np.where(np.isnan(observed), np.nan, p_value)
+
+
+def _window_samples(ds, years):
+    # Values of portion_suitable for each realization and year in the window, along a
+    # "sample" dimension. ds is either epi model results, or partial reductions from
+    # the reduction cache (which have a "file" dimension).
+    if "file" in ds.dims:
+        ds_window = ds.isel(file=ds.year.isin(list(years)).values)
+        da_samples = (
+            ds_window["portion_suitable_sum"] / ds_window["portion_suitable_count"]
+        ).rename(file="sample")
+    else:
+        da_samples = (
+            ds["portion_suitable"]
+            .sel(time=ds.time.dt.year.isin(years))
+            .stack(sample=["realization", "time"])
+        )
+    return da_samples.drop_vars(
+        [name for name in da_samples.coords if "sample" in da_samples[name].dims]
+    ).squeeze(drop=True)
@@ -0,0 +1,27 @@
+import numpy as np
+
+# Lightweight helpers for lat/lon grids, kept free of the plotting stack (cartopy etc.)
+# so that data scripts can use them without importing it.
+
+
+def nearest_index(coord, points, periodic=False):
+    """Index of the grid cell of coord containing each point, or -1 outside the grid.
+
+    Cell edges are assumed midway between coordinates. Periodic coordinates
+    (longitudes) wrap around if the grid is global.
+    """
+    order = np.argsort(coord)
+    coord = coord[order]
+    midpoints = (coord[:-1] + coord[1:]) / 2
+    lower = coord[0] - (coord[1] - coord[0]) / 2
+    upper = coord[-1] + (coord[-1] - coord[-2]) / 2
+    valid = np.isfinite(points)
+    points = np.where(valid, points, coord[0])
+    if periodic:
+        points = (points - lower) % 360 + lower
+    index = np.searchsorted(midpoints, points)
+    if periodic and upper - lower >= 360 - 1e-6:
+        index[points - coord[-1] > coord[0] + 360 - points] = 0
+    else:
+        valid &= (points >= lower) & (points <= upper)
+    return np.where(valid, order[index], -1)
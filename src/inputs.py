@@ -2,6 +2,8 @@ import itertools
 import pathlib
 
 DATA_DIR = pathlib.Path(__file__).parents[1] / "data"
+# Occurrence data from https://doi.org/10.1038/s41467-025-58609-5
+OCCURRENCE_DATA_PATH = DATA_DIR / "arbo_occ_thinned.csv"
 
 DATASETS = {
     "arise_control": {
@@ -44,9 +46,19 @@ DATASETS = {
 
 EPI_MODEL_NAME = "mordecai_ae_aegypti_niche"
 ALT_EPI_MODEL_NAME = "mordecai_ae_albopictus_niche"
+EPI_MODELS = [EPI_MODEL_NAME, ALT_EPI_MODEL_NAME]
 
 YEARS_PER_JOB = 10
 REALIZATIONS_PER_JOB = 1
+WORKERS_PER_JOB = 1
+
+# Write epi model results as per-year NetCDF files ("netcdf") or into a single Zarr
+# store per dataset and epi model ("zarr")
+EPI_OUTPUT_FORMAT = "netcdf"
+
+# Render figure panels with bokeh ("bokeh", requires a headless browser) or matplotlib
+# ("matplotlib")
+RENDER_BACKEND = "bokeh"
 
 
 def get_batches(dataset):
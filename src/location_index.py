@@ -0,0 +1,141 @@
+import hashlib
+import json
+import pathlib
+
+import numpy as np
+import xarray as xr
+
+from grid_utils import nearest_index
+from parallel_utils import atomic_save_paths
+
+# Index of locations on model grids, for extracting time series at many locations at
+# once. Location names are geocoded once (results/location_index/geocoded.json), and
+# the grid cell containing each location is found once per grid (saved under
+# results/location_index/grids, keyed by a hash of the grid coordinates). Locations
+# are then extracted with a single vectorized isel along a "location" dimension.
+
+INDEX_DIR = pathlib.Path(__file__).parents[1] / "results/location_index"
+
+_GEOCODED_CACHE = {}
+_GRID_INDEX_CACHE = {}
+
+
+def extract_locations(ds, locations):
+    """Extract the grid cells containing each location, along a "location" dimension.
+
+    locations is a list of names (geocoded with Nominatim), or a dict of name: (lat,
+    lon). The location latitudes and longitudes are kept as location_lat and
+    location_lon coordinates.
+    """
+    if not isinstance(locations, dict):
+        locations = geocode_locations(locations)
+    names = list(locations)
+    location_lat = np.array([locations[name][0] for name in names], dtype=np.float64)
+    location_lon = np.array([locations[name][1] for name in names], dtype=np.float64)
+    lat_index, lon_index = get_location_indices(
+        ds.lat.values, ds.lon.values, names, location_lat, location_lon
+    )
+    if (lat_index < 0).any() or (lon_index < 0).any():
+        outside = [
+            name for name, i, j in zip(names, lat_index, lon_index) if i < 0 or j < 0
+        ]
+        raise ValueError(f"Locations outside the grid: {outside}")
+    return ds.isel(
+        lat=xr.DataArray(lat_index, dims="location"),
+        lon=xr.DataArray(lon_index, dims="location"),
+    ).assign_coords(
+        location=names,
+        location_lat=("location", location_lat),
+        location_lon=("location", location_lon),
+    )
+
+
+def get_location_indices(lat, lon, names, location_lat, location_lon):
+    """Return the (lat, lon) indices of the grid cells containing each location."""
+    grid_key = _get_grid_key(lat, lon)
+    index = _load_grid_index(grid_key)
+    is_cached = np.array(
+        [
+            name in index
+            and index[name][0] == location_lat[k]
+            and index[name][1] == location_lon[k]
+            for k, name in enumerate(names)
+        ],
+        dtype=bool,
+    )
+    if not is_cached.all():
+        new = np.flatnonzero(~is_cached)
+        lat_index_new = nearest_index(lat, location_lat[new], periodic=False)
+        lon_index_new = nearest_index(lon, location_lon[new], periodic=True)
+        for k, i, j in zip(new, lat_index_new, lon_index_new):
+            index[names[k]] = [
+                float(location_lat[k]),
+                float(location_lon[k]),
+                int(i),
+                int(j),
+            ]
+        _save_json(index, _get_index_dir() / "grids" / f"{grid_key}.json")
+    return (
+        np.array([index[name][2] for name in names], dtype=np.int64),
+        np.array([index[name][3] for name in names], dtype=np.int64),
+    )
+
+
+def geocode_locations(names):
+    """Return a dict of name: (lat, lon), geocoding names not already geocoded."""
+    geocoded = _load_geocoded()
+    missing = [name for name in names if name not in geocoded]
+    if missing:
+        from geopy.extra.rate_limiter import RateLimiter
+        from geopy.geocoders import Nominatim
+
+        print(f"Geocoding {len(missing)} locations...")
+        geocode = RateLimiter(
+            Nominatim(user_agent="climate-intervention-vbd").geocode,
+            min_delay_seconds=1,
+        )
+        for name in missing:
+            result = geocode(name)
+            if result is None:
+                raise ValueError(f"Could not geocode {name}.")
+            geocoded[name] = [result.latitude, result.longitude]
+        _save_json(geocoded, _get_index_dir() / "geocoded.json")
+    return {name: tuple(geocoded[name]) for name in names}
+
+
+def _load_geocoded():
+    if not _GEOCODED_CACHE:
+        geocoded_path = _get_index_dir() / "geocoded.json"
+        if geocoded_path.exists():
+            with open(geocoded_path, encoding="utf-8") as f:
+                _GEOCODED_CACHE.update(json.load(f))
+    return _GEOCODED_CACHE
+
+
+def _load_grid_index(grid_key):
+    if grid_key not in _GRID_INDEX_CACHE:
+        index_path = _get_index_dir() / "grids" / f"{grid_key}.json"
+        index = {}
+        if index_path.exists():
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        _GRID_INDEX_CACHE[grid_key] = index
+    return _GRID_INDEX_CACHE[grid_key]
+
+
+def _save_json(obj, save_path):
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_save_paths([save_path], shared_cache=True) as (tmp_path,):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(obj, f)
+
+
+def _get_grid_key(lat, lon):
+    key_hash = hashlib.sha256()
+    for values in [lat, lon]:
+        key_hash.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return key_hash.hexdigest()
+
+
+def _get_index_dir():
+    return pathlib.Path(INDEX_DIR)
@@ -1,15 +1,22 @@
 import argparse
+import json
 import pathlib
 
+import pandas as pd
 import xarray as xr
 
+from epi_store import get_epi_store_marker_dir, open_epi_store
 from figure_data_functions import (
     make_change_example_plot_data,
+    make_comparison_data,
     make_location_example_plot_data,
-    make_mean_plot_data,
+    make_location_time_series_data,
+    make_multi_window_mean_plot_data,
     make_temperature_time_series_plot_data,
 )
 from inputs import EPI_MODEL_NAME
+from reduction_cache import load_reduction_cache
+from window_mean_cache import get_input_key
 
 
 def _make_temperature_figure_data(downscaled=False):
@@ -45,48 +52,83 @@ def _make_temperature_figure_data(downscaled=False):
     )
 
 
-def _make_epi_figure_data(downscaled=False, epi_model_name=None):
+def _make_epi_figure_data(
+    downscaled=False,
+    epi_model_name=None,
+    zarr=False,
+    reduction_cache=False,
+    ensemble_spread=False,
+    significance=False,
+    locations_path=None,
+    comparisons_path=None,
+):
+    if zarr and reduction_cache:
+        raise ValueError("The reduction cache is only available for NetCDF results.")
     save_dir = (
         pathlib.Path(__file__).parents[1]
         / f"results/figure_data/{'downscaled' if downscaled else 'native'}/"
         f"{epi_model_name}"
     )
     save_dir.mkdir(parents=True, exist_ok=True)
-    ds_control = xr.open_mfdataset(
-        str(
-            pathlib.Path(__file__).parents[1]
-            / f"results/{epi_model_name}/arise_control"
-            f"{'_downscaled' if downscaled else ''}/*.nc"
-        ),
-        chunks={},
-        data_vars="minimal",
-        coords="minimal",
-        compat="override",
+    ds_control = _open_epi_results(
+        dataset=f"arise_control{'_downscaled' if downscaled else ''}",
+        epi_model_name=epi_model_name,
+        zarr=zarr,
     )
-    ds_feedback = xr.open_mfdataset(
-        str(
-            pathlib.Path(__file__).parents[1]
-            / f"results/{epi_model_name}/arise_feedback"
-            f"{'_downscaled' if downscaled else ''}/*.nc"
-        ),
-        chunks={},
-        data_vars="minimal",
-        coords="minimal",
-        compat="override",
+    ds_feedback = _open_epi_results(
+        dataset=f"arise_feedback{'_downscaled' if downscaled else ''}",
+        epi_model_name=epi_model_name,
+        zarr=zarr,
     )
-    # Data generated for both epi models
-    print("Making mean data...")
-    make_mean_plot_data(
-        ds_control=ds_control,
-        ds_feedback=ds_feedback,
-        save_path=save_dir / "mean.nc",
+    if reduction_cache:
+        # Window means are built from cached per-file partial reductions (location
+        # data still need the full results)
+        ds_control_means = load_reduction_cache(
+            dataset=f"arise_control{'_downscaled' if downscaled else ''}",
+            epi_model_name=epi_model_name,
+        )
+        ds_feedback_means = load_reduction_cache(
+            dataset=f"arise_feedback{'_downscaled' if downscaled else ''}",
+            epi_model_name=epi_model_name,
+        )
+    else:
+        ds_control_means = ds_control
+        ds_feedback_means = ds_feedback
+    # Window means are memoized (in process and on disk) against the result files
+    input_keys = {
+        scenario: _get_input_key(
+            dataset=f"arise_{scenario}{'_downscaled' if downscaled else ''}",
+            epi_model_name=epi_model_name,
+            zarr=zarr,
+        )
+        for scenario in ["control", "feedback"]
+    }
+    # Mean data, for all (before_years, after_years) windows in a single pass
+    mean_windows = {"mean": (range(2025, 2035), range(2035, 2045))}
+    if epi_model_name == EPI_MODEL_NAME:
+        mean_windows.update(
+            current=(range(2015, 2025), None),
+            later_mean=(range(2025, 2035), range(2045, 2055)),
+            even_later_mean=(range(2025, 2035), range(2055, 2065)),
+        )
+    print(f"Making mean data ({', '.join(mean_windows)})...")
+    make_multi_window_mean_plot_data(
+        ds_control=ds_control_means,
+        ds_feedback=ds_feedback_means,
+        windows=list(mean_windows.values()),
+        save_paths=[save_dir / f"{name}.nc" for name in mean_windows],
+        ensemble_spread=ensemble_spread,
+        significance=significance,
+        input_keys=input_keys,
     )
+    # Other data generated for both epi models
     print("Making change example data...")
     make_change_example_plot_data(
-        ds_control=ds_control,
-        ds_feedback=ds_feedback,
+        ds_control=ds_control_means,
+        ds_feedback=ds_feedback_means,
         realizations=[0, 1, 5, 6],
         save_path=save_dir / "change_example.nc",
+        input_keys=input_keys,
     )
     print("Making location example data...")
     make_location_example_plot_data(
@@ -95,36 +137,43 @@ def _make_epi_figure_data(downscaled=False, epi_model_name=None):
         locations=["London", "Seattle", "Cape Town", "Santiago de Chile"],
         save_path=save_dir / "location.nc",
     )
+    if locations_path is not None:
+        print("Making location time series data...")
+        df_locations = pd.read_csv(locations_path)
+        make_location_time_series_data(
+            ds_control=ds_control,
+            ds_feedback=ds_feedback,
+            locations={
+                name: (lat, lon)
+                for name, lat, lon in zip(
+                    df_locations["name"], df_locations["lat"], df_locations["lon"]
+                )
+            },
+            save_path=save_dir / "location_time_series.nc",
+        )
+    if comparisons_path is not None:
+        # Each entry maps an output name to the comparisons saved in it (see
+        # make_comparison_data, with pairs of specs as JSON lists)
+        with open(comparisons_path, encoding="utf-8") as f:
+            comparisons_all = json.load(f)
+        for name, comparisons in comparisons_all.items():
+            print(f"Making comparison data ({name})...")
+            make_comparison_data(
+                datasets={"control": ds_control_means, "feedback": ds_feedback_means},
+                comparisons=comparisons,
+                save_path=save_dir / f"{name}.nc",
+                input_keys=input_keys,
+            )
     if epi_model_name != EPI_MODEL_NAME:
         return
-    # Data generated only for the primary epi model
-    print("Making current data...")
-    make_mean_plot_data(
-        ds_control=ds_control,
-        ds_feedback=None,
-        before_years=range(2015, 2025),
-        after_years=None,
-        save_path=save_dir / "current.nc",
-    )
-    print("Making later mean data...")
-    make_mean_plot_data(
-        ds_control=ds_control,
-        ds_feedback=ds_feedback,
-        after_years=range(2045, 2055),
-        save_path=save_dir / "later_mean.nc",
-    )
-    make_mean_plot_data(
-        ds_control=ds_control,
-        ds_feedback=ds_feedback,
-        after_years=range(2055, 2065),
-        save_path=save_dir / "even_later_mean.nc",
-    )
+    # Other data generated only for the primary epi model
     print("Making change example (other realizations) data...")
     make_change_example_plot_data(
-        ds_control=ds_control,
-        ds_feedback=ds_feedback,
+        ds_control=ds_control_means,
+        ds_feedback=ds_feedback_means,
         realizations=[2, 3, 4, 7, 8, 9],
         save_path=save_dir / "change_example_others.nc",
+        input_keys=input_keys,
     )
     print("Making location example (other locations) data...")
     make_location_example_plot_data(
@@ -142,6 +191,34 @@ def _make_epi_figure_data(downscaled=False, epi_model_name=None):
     )
 
 
+def _get_input_key(dataset=None, epi_model_name=None, zarr=False):
+    if zarr:
+        # Marker files are rewritten whenever a region of the store is written
+        paths = get_epi_store_marker_dir(
+            dataset=dataset, epi_model_name=epi_model_name
+        ).glob("*.txt")
+    else:
+        paths = (
+            pathlib.Path(__file__).parents[1] / f"results/{epi_model_name}/{dataset}"
+        ).glob("*.nc")
+    return get_input_key(paths)
+
+
+def _open_epi_results(dataset=None, epi_model_name=None, zarr=False):
+    if zarr:
+        return open_epi_store(dataset=dataset, epi_model_name=epi_model_name)
+    return xr.open_mfdataset(
+        str(
+            pathlib.Path(__file__).parents[1]
+            / f"results/{epi_model_name}/{dataset}/*.nc"
+        ),
+        chunks={},
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Generate figures comparing intervention and control scenarios."
@@ -162,12 +239,56 @@ if __name__ == "__main__":
         default=None,
         help="Epi model name to run",
     )
+    parser.add_argument(
+        "--zarr",
+        action="store_true",
+        help="Whether to read epi model results from Zarr stores (rather than NetCDF).",
+    )
+    parser.add_argument(
+        "--reduction-cache",
+        action="store_true",
+        help="Whether to build window means from cached per-file partial reductions "
+        "(NetCDF results only).",
+    )
+    parser.add_argument(
+        "--ensemble-spread",
+        action="store_true",
+        help="Whether to add ensemble percentiles and standard deviations to the mean "
+        "data.",
+    )
+    parser.add_argument(
+        "--significance",
+        action="store_true",
+        help="Whether to add permutation test p-values for the with vs without "
+        "intervention difference to the mean data.",
+    )
+    parser.add_argument(
+        "--locations-file",
+        type=str,
+        default=None,
+        help="CSV file of locations (with name, lat and lon columns) for which to save "
+        "time series.",
+    )
+    parser.add_argument(
+        "--comparisons-file",
+        type=str,
+        default=None,
+        help="JSON file mapping output names to window comparisons (see "
+        "figure_data_functions.make_comparison_data) to save.",
+    )
     args = parser.parse_args()
     if args.temperature:
         _make_temperature_figure_data(downscaled=args.downscaled)
     if args.epi_model_name:
         _make_epi_figure_data(
-            downscaled=args.downscaled, epi_model_name=args.epi_model_name
+            downscaled=args.downscaled,
+            epi_model_name=args.epi_model_name,
+            zarr=args.zarr,
+            reduction_cache=args.reduction_cache,
+            ensemble_spread=args.ensemble_spread,
+            significance=args.significance,
+            locations_path=args.locations_file,
+            comparisons_path=args.comparisons_file,
         )
     elif not args.temperature:
         raise ValueError(
@@ -1,88 +1,247 @@
 import argparse
+import collections
+import hashlib
+import json
 import pathlib
+import shutil
+import subprocess
 
 import svgutils.compose as svgc
 
-from inputs import ALT_EPI_MODEL_NAME, EPI_MODEL_NAME
-from plotting_functions import (
-    make_change_example_plots,
-    make_current_plot,
-    make_location_example_plots,
-    make_mean_plots,
-    make_temperature_time_series_plot,
+from inputs import (
+    ALT_EPI_MODEL_NAME,
+    EPI_MODEL_NAME,
+    OCCURRENCE_DATA_PATH,
+    RENDER_BACKEND,
 )
 
+# The plotting stack (and xarray and dask) is only imported by the functions that need
+# it, so that compiling figures from existing panels starts quickly. PNGs are exported
+# with rsvg-convert (from librsvg).
 
-def make_common_panels(downscaled=False, epi_model_name=None):
+
+def make_panels(
+    downscaled=False, force=False, jobs=1, browsers=1, backend=RENDER_BACKEND
+):
+    """Make all panels, running each plotting call as a task on up to jobs processes.
+
+    All tasks are run even if some fail; failures are then reported per task and
+    raised, so figures are only compiled once all their panels exist.
+    """
+    from panel_cache import make_panels_cached
+    from parallel_utils import run_tasks
+
+    _init_panel_worker(backend, browsers)
+    tasks = _get_primary_panel_tasks(downscaled=downscaled, force=force)
+    for epi_model_name in [EPI_MODEL_NAME, ALT_EPI_MODEL_NAME]:
+        tasks += _get_common_panel_tasks(
+            downscaled=downscaled, epi_model_name=epi_model_name, force=force
+        )
+    results = run_tasks(
+        make_panels_cached,
+        tasks,
+        workers=jobs,
+        initializer=_init_panel_worker,
+        initargs=(backend, browsers),
+        return_exceptions=True,
+    )
+    failures = {
+        task["cache_name"]: result
+        for task, result in zip(tasks, results)
+        if isinstance(result, Exception)
+    }
+    cache_results = collections.Counter(
+        result for result in results if not isinstance(result, Exception)
+    )
+    print(f"Panel cache: {cache_results['hit']} hits, {cache_results['miss']} misses")
+    if failures:
+        for cache_name, exc in failures.items():
+            print(f"Failed to make panels for {cache_name}: {exc!r}")
+        raise RuntimeError(
+            f"Failed to make panels for {len(failures)} of {len(tasks)} tasks."
+        )
+
+
+def _get_common_panel_tasks(downscaled=False, epi_model_name=None, force=False):
     # Panels shown for both epi models
     if epi_model_name is None:
         raise ValueError("epi_model_name must be provided.")
     data_dir = _get_data_dir(downscaled=downscaled, epi_model_name=epi_model_name)
     panel_dir = _get_panel_dir(downscaled=downscaled, epi_model_name=epi_model_name)
-    print(f"Making mean panels for {epi_model_name}...")
-    make_mean_plots(
-        data_path=data_dir / "mean.nc",
-        save_base_path=panel_dir / "mean",
-        clim_diff=(-30, 30),
-    )
-    print(f"Making change example panels for {epi_model_name}...")
-    make_change_example_plots(
-        data_path=data_dir / "change_example.nc",
-        save_base_path=panel_dir / "change_example",
-        clim=(-30, 30),
-    )
-    print(f"Making location example panels for {epi_model_name}...")
-    make_location_example_plots(
-        data_path=data_dir / "location.nc",
-        highlight_realization=0,
-        save_base_path=panel_dir / "location",
-    )
+    return [
+        _panel_task(
+            "make_mean_plots",
+            data_path=data_dir / "mean.nc",
+            save_base_path=panel_dir / "mean",
+            force=force,
+            clim_diff=(-30, 30),
+        ),
+        *_split_panel_task(
+            _panel_task(
+                "make_change_example_plots",
+                data_path=data_dir / "change_example.nc",
+                save_base_path=panel_dir / "change_example",
+                force=force,
+                clim=(-30, 30),
+            ),
+            dim="realization",
+        ),
+        *_split_panel_task(
+            _panel_task(
+                "make_location_example_plots",
+                data_path=data_dir / "location.nc",
+                save_base_path=panel_dir / "location",
+                force=force,
+                highlight_realization=0,
+            ),
+            dim="location",
+        ),
+    ]
 
 
-def make_primary_panels(downscaled=False):
+def _get_primary_panel_tasks(downscaled=False, force=False):
     # Panels shown only for the primary epi model, plus the model-independent
     # temperature time series
     data_dir = _get_data_dir(downscaled=downscaled, epi_model_name=EPI_MODEL_NAME)
     panel_dir = _get_panel_dir(downscaled=downscaled, epi_model_name=EPI_MODEL_NAME)
-    print("Making temperature time series panel...")
-    make_temperature_time_series_plot(
-        data_path=data_dir.parent / "temperature_time_series.nc",
-        save_base_path=panel_dir.parent / "temperature_time_series",
-    )
-    print("Making current suitability panel...")
-    make_current_plot(
-        data_path=data_dir / "current.nc",
-        panel_label="B",
-        save_base_path=panel_dir / "current",
-    )
-    print("Making later mean panels...")
-    make_mean_plots(
-        data_path=data_dir / "later_mean.nc",
-        panel_labels=["", "A", "C", "E"],
-        save_base_path=panel_dir / "later_mean",
-        clim_diff=(-50, 50),
-    )
-    make_mean_plots(
-        data_path=data_dir / "even_later_mean.nc",
-        panel_labels=["", "B", "D", "F"],
-        save_base_path=panel_dir / "even_later_mean",
-        clim_diff=(-80, 80),
+    return [
+        _panel_task(
+            "make_temperature_time_series_plot",
+            data_path=data_dir.parent / "temperature_time_series.nc",
+            save_base_path=panel_dir.parent / "temperature_time_series",
+            force=force,
+        ),
+        _panel_task(
+            "make_current_plot",
+            data_path=data_dir / "current.nc",
+            save_base_path=panel_dir / "current",
+            extra_input_paths=[OCCURRENCE_DATA_PATH],
+            force=force,
+            panel_label="B",
+        ),
+        _panel_task(
+            "make_mean_plots",
+            data_path=data_dir / "later_mean.nc",
+            save_base_path=panel_dir / "later_mean",
+            force=force,
+            panel_labels=["", "A", "C", "E"],
+            clim_diff=(-50, 50),
+        ),
+        _panel_task(
+            "make_mean_plots",
+            data_path=data_dir / "even_later_mean.nc",
+            save_base_path=panel_dir / "even_later_mean",
+            force=force,
+            panel_labels=["", "B", "D", "F"],
+            clim_diff=(-80, 80),
+        ),
+        *_split_panel_task(
+            _panel_task(
+                "make_change_example_plots",
+                data_path=data_dir / "change_example_others.nc",
+                save_base_path=panel_dir / "change_example_others",
+                force=force,
+                clim=(-30, 30),
+            ),
+            dim="realization",
+            panel_labels=["A", "C", "E", "B", "D", "F"],
+        ),
+        *_split_panel_task(
+            _panel_task(
+                "make_location_example_plots",
+                data_path=data_dir / "location_others.nc",
+                save_base_path=panel_dir / "location_others",
+                force=force,
+                highlight_realization=0,
+            ),
+            dim="location",
+        ),
+    ]
+
+
+def _panel_task(plot_fn_name, *, save_base_path, **kwargs):
+    return {
+        "plot_fn_name": plot_fn_name,
+        "save_base_path": save_base_path,
+        "cache_name": save_base_path.name,
+        **kwargs,
+    }
+
+
+def _split_panel_task(task, dim, panel_labels=None):
+    # Splits a task plotting one panel per realization or location into one task per
+    # panel (requires any color limits to be set explicitly, since by default these
+    # depend on all panels)
+    import xarray as xr
+
+    with xr.open_dataset(task["data_path"]) as ds:
+        values = ds[dim].values.tolist()
+    if panel_labels is None:
+        panel_labels = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")[: len(values)]
+    split_tasks = []
+    for value, panel_label in zip(values, panel_labels):
+        if dim == "realization":
+            panel_name = f"ID_{value + 1:03d}"
+        else:
+            panel_name = value.lower().replace(" ", "_")
+        split_tasks.append(
+            {
+                **task,
+                f"{dim}s": [value],
+                "panel_labels": [panel_label],
+                "cache_name": f"{task['cache_name']}_{panel_name}",
+            }
+        )
+    return split_tasks
+
+
+def _init_panel_worker(backend, browsers):
+    from plotting_functions import set_render_backend, set_webdriver_pool_size
+
+    set_render_backend(backend)
+    set_webdriver_pool_size(browsers)
+
+
+def compile_figures(downscaled=False):
+    compile_primary_figures(
+        downscaled=downscaled,
+        current_figure_number=1,
+        later_mean_figure_number="S1",
+        change_example_others_figure_number="S2",
+        location_others_figure_number="S3",
     )
-    print("Making change example (other realizations) panels...")
-    make_change_example_plots(
-        data_path=data_dir / "change_example_others.nc",
-        save_base_path=panel_dir / "change_example_others",
-        panel_labels=["A", "C", "E", "B", "D", "F"],
-        clim=(-30, 30),
+    compile_common_figures(
+        downscaled=downscaled,
+        epi_model_name=EPI_MODEL_NAME,
+        mean_figure_number=2,
+        change_example_figure_number=3,
+        location_figure_number=4,
     )
-    print("Making location example (other locations) panels...")
-    make_location_example_plots(
-        data_path=data_dir / "location_others.nc",
-        highlight_realization=0,
-        save_base_path=panel_dir / "location_others",
+    compile_common_figures(
+        downscaled=downscaled,
+        epi_model_name=ALT_EPI_MODEL_NAME,
+        mean_figure_number="S4",
+        change_example_figure_number="S5",
+        location_figure_number="S6",
     )
 
 
+def export_pngs(downscaled=False, dpi=96, jobs=1):
+    """Export each compiled figure as a PNG next to its SVG, on up to jobs processes.
+
+    Figures whose SVG (and the DPI) have not changed since the last export are skipped.
+    """
+    from parallel_utils import run_tasks
+
+    figure_dir = _get_figure_dir(downscaled=downscaled)
+    tasks = [
+        {"svg_path": svg_path, "dpi": dpi}
+        for svg_path in sorted(figure_dir.glob("figure_*.svg"))
+    ]
+    exported = run_tasks(_export_png, tasks, workers=jobs)
+    print(f"Exported {sum(exported)} PNGs ({len(exported) - sum(exported)} unchanged)")
+
+
 def compile_common_figures(
     downscaled=False,
     epi_model_name=None,
@@ -199,6 +358,42 @@ def compile_primary_figures(
     )
 
 
+def _export_png(svg_path, dpi=96):
+    from parallel_utils import atomic_save_paths
+
+    png_path = svg_path.with_suffix(".png")
+    root = pathlib.Path(__file__).parents[1]
+    record_path = (
+        root / "results/png_cache" / png_path.relative_to(root / "figures")
+    ).with_suffix(".json")
+    record_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(svg_path, "rb") as f:
+        record = {"svg_sha256": hashlib.sha256(f.read()).hexdigest(), "dpi": dpi}
+    if png_path.exists() and record_path.exists():
+        with open(record_path, encoding="utf-8") as f:
+            if json.load(f) == record:
+                return False
+    rsvg_convert = shutil.which("rsvg-convert")
+    if rsvg_convert is None:
+        raise RuntimeError("rsvg-convert (from librsvg) is needed to export PNGs.")
+    with atomic_save_paths([png_path]) as (tmp_path,):
+        # SVG sizes are in px, which rsvg-convert (like inkscape) renders at 96 DPI
+        subprocess.run(
+            [
+                rsvg_convert,
+                f"--zoom={dpi / 96}",
+                "--format=png",
+                f"--output={tmp_path}",
+                str(svg_path),
+            ],
+            check=True,
+        )
+    with atomic_save_paths([record_path]) as (tmp_path,):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=1)
+    return True
+
+
 def _get_data_dir(downscaled=False, epi_model_name=None):
     data_dir = (
         pathlib.Path(__file__).parents[1]
@@ -252,32 +447,59 @@ if __name__ == "__main__":
         action="store_true",
         help="Only compile figures from existing panels.",
     )
-    args = parser.parse_args()
-    if not args.compile_only:
-        make_primary_panels(downscaled=args.downscaled)
-        make_common_panels(downscaled=args.downscaled, epi_model_name=EPI_MODEL_NAME)
-        make_common_panels(
-            downscaled=args.downscaled, epi_model_name=ALT_EPI_MODEL_NAME
-        )
-    print("Compiling figures...")
-    compile_primary_figures(
-        downscaled=args.downscaled,
-        current_figure_number=1,
-        later_mean_figure_number="S1",
-        change_example_others_figure_number="S2",
-        location_others_figure_number="S3",
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-render all panels, ignoring the panel cache.",
     )
-    compile_common_figures(
-        downscaled=args.downscaled,
-        epi_model_name=EPI_MODEL_NAME,
-        mean_figure_number=2,
-        change_example_figure_number=3,
-        location_figure_number=4,
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to make panels in parallel.",
     )
-    compile_common_figures(
-        downscaled=args.downscaled,
-        epi_model_name=ALT_EPI_MODEL_NAME,
-        mean_figure_number="S4",
-        change_example_figure_number="S5",
-        location_figure_number="S6",
+    parser.add_argument(
+        "--browsers",
+        type=int,
+        default=1,
+        help="Number of headless browser sessions (per process) used to export "
+        "panels concurrently.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default=RENDER_BACKEND,
+        choices=["bokeh", "matplotlib"],
+        help="Rendering backend for panels (matplotlib does not require a browser).",
+    )
+    parser.add_argument(
+        "--png",
+        action="store_true",
+        help="Also export each figure as a PNG (next to the SVG).",
+    )
+    parser.add_argument(
+        "--png-only",
+        action="store_true",
+        help="Only export PNGs from existing figures.",
     )
+    parser.add_argument(
+        "--dpi",
+        type=float,
+        default=96,
+        help="Resolution of exported PNGs (96 gives 1 pixel per SVG px).",
+    )
+    args = parser.parse_args()
+    if not args.png_only:
+        if not args.compile_only:
+            make_panels(
+                downscaled=args.downscaled,
+                force=args.force,
+                jobs=args.jobs,
+                browsers=args.browsers,
+                backend=args.backend,
+            )
+        print("Compiling figures...")
+        compile_figures(downscaled=args.downscaled)
+    if args.png or args.png_only:
+        print("Exporting PNGs...")
+        export_pngs(downscaled=args.downscaled, dpi=args.dpi, jobs=args.jobs)
@@ -0,0 +1,114 @@
+import hashlib
+import math
+import pathlib
+
+import cartopy.crs as ccrs
+import numpy as np
+import xarray as xr
+
+from grid_utils import nearest_index
+from parallel_utils import atomic_save_paths
+
+# Cache of mappings from model grid cells to the pixels of projected map rasters. For a
+# given grid, projection and raster shape, the mapping holds the (flattened) index of
+# the nearest grid cell to each of a few sub-pixel sample points per pixel (-1 outside
+# the grid), so that any field on the grid can be projected and rasterized with a
+# single gather. Mappings are kept in memory and saved under results/map_raster_cache.
+
+RASTER_SHAPE = (250, 500)  # (height, width), matching the frame size of map panels
+MAX_SUPERSAMPLING = 4
+CACHE_DIR = pathlib.Path(__file__).parents[1] / "results/map_raster_cache"
+
+_MAPPING_CACHE = {}
+
+
+def project_raster(da, projection=None, shape=RASTER_SHAPE):
+    """Project a field on a lat/lon grid to a raster covering the projection's extent.
+
+    Each pixel is the mean of the grid cells sampled within it (NaN if none are
+    valid). Returns a DataArray with dims (y, x) and coordinates in the projection.
+    """
+    if projection is None:
+        projection = ccrs.PlateCarree()
+    da = da.squeeze(drop=True).transpose("lat", "lon")
+    x, y, index = _get_mapping(
+        da.lon.values, da.lat.values, projection=projection, shape=shape
+    )
+    samples = np.where(index >= 0, da.values.ravel()[index.clip(min=0)], np.nan)
+    count = np.sum(~np.isnan(samples), axis=-1)
+    raster = np.divide(
+        np.nansum(samples, axis=-1),
+        count,
+        out=np.full(count.shape, np.nan),
+        where=count > 0,
+    )
+    return xr.DataArray(
+        raster,
+        dims=("y", "x"),
+        coords={"y": y, "x": x},
+        name=da.name,
+        attrs=da.attrs,
+    )
+
+
+def _get_mapping(lon, lat, projection, shape):
+    key = _get_mapping_key(lon, lat, projection=projection, shape=shape)
+    if key in _MAPPING_CACHE:
+        return _MAPPING_CACHE[key]
+    cache_path = _get_cache_dir() / f"{key}.npz"
+    if cache_path.exists():
+        with np.load(cache_path) as f:
+            mapping = (f["x"], f["y"], f["index"])
+    else:
+        mapping = _compute_mapping(lon, lat, projection=projection, shape=shape)
+        with atomic_save_paths([cache_path], shared_cache=True) as (tmp_path,):
+            with open(tmp_path, "wb") as f:
+                np.savez(f, x=mapping[0], y=mapping[1], index=mapping[2])
+    _MAPPING_CACHE[key] = mapping
+    return mapping
+
+
+def _compute_mapping(lon, lat, projection, shape):
+    height, width = shape
+    # Sample each pixel at factor x factor points, so that pixels covering several grid
+    # cells are averaged over them (as when rasterizing with datashader)
+    factor = min(
+        max(math.ceil(len(lon) / width), math.ceil(len(lat) / height), 1),
+        MAX_SUPERSAMPLING,
+    )
+    offsets = (np.arange(factor) + 0.5) / factor
+    x_min, x_max = projection.x_limits
+    y_min, y_max = projection.y_limits
+    dx = (x_max - x_min) / width
+    dy = (y_max - y_min) / height
+    x = x_min + (np.arange(width) + 0.5) * dx
+    y = y_min + (np.arange(height) + 0.5) * dy
+    x_samples = x_min + (np.arange(width)[:, None] + offsets[None, :]) * dx
+    y_samples = y_min + (np.arange(height)[:, None] + offsets[None, :]) * dy
+    x_samples, y_samples = np.broadcast_arrays(
+        x_samples[None, :, None, :], y_samples[:, None, :, None]
+    )
+    lonlat = ccrs.PlateCarree().transform_points(
+        projection, x_samples.ravel(), y_samples.ravel()
+    )
+    lon_index = nearest_index(lon, lonlat[:, 0], periodic=True)
+    lat_index = nearest_index(lat, lonlat[:, 1], periodic=False)
+    index = np.where(
+        (lon_index >= 0) & (lat_index >= 0), lat_index * len(lon) + lon_index, -1
+    )
+    return x, y, index.reshape(height, width, factor**2)
+
+
+def _get_mapping_key(lon, lat, projection, shape):
+    key_hash = hashlib.sha256()
+    for values in [lon, lat]:
+        key_hash.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    key_hash.update(projection.to_wkt().encode())
+    key_hash.update(f"{shape}_{MAX_SUPERSAMPLING}".encode())
+    return key_hash.hexdigest()
+
+
+def _get_cache_dir():
+    cache_dir = pathlib.Path(CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
@@ -0,0 +1,98 @@
+import pathlib
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from grid_utils import nearest_index
+from inputs import OCCURRENCE_DATA_PATH
+from parallel_utils import atomic_save_paths
+
+# Occurrence data (from https://doi.org/10.1038/s41467-025-58609-5), cached in a compact
+# columnar binary form. Rows are sorted by disease, with an index of the rows for each
+# disease, so that loading one disease does not require parsing or filtering the CSV.
+# The cache (under results/occurrence_cache) is rebuilt whenever the CSV changes.
+
+# Year is stored as a float so that the few rows with a missing ("NA") year are kept,
+# as NaN; Admin has no missing values (-999 is its own code) so is stored as an integer
+_COLUMNS = {
+    "Longitude": np.float64,
+    "Latitude": np.float64,
+    "Admin": np.int16,
+    "Year": np.float64,
+}
+_OCCURRENCE_CACHE = {}
+
+
+def load_occurrence_points(disease="dengue", data_path=OCCURRENCE_DATA_PATH):
+    """Return a DataFrame of occurrence points (Longitude, Latitude, Admin, Year)."""
+    columns = _load_occurrence_columns(data_path)
+    diseases = columns["disease_names"].tolist()
+    if disease not in diseases:
+        raise ValueError(f"No occurrence data for {disease} (available: {diseases}).")
+    i = diseases.index(disease)
+    rows = slice(columns["disease_offsets"][i], columns["disease_offsets"][i + 1])
+    return pd.DataFrame({name: columns[name][rows] for name in _COLUMNS}).reset_index(
+        drop=True
+    )
+
+
+def get_gridded_occurrence(lon, lat, disease="dengue", data_path=OCCURRENCE_DATA_PATH):
+    """Return the number of occurrence points in each cell of a lat/lon grid."""
+    df = load_occurrence_points(disease, data_path=data_path)
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    lon_index = nearest_index(lon, df["Longitude"].values, periodic=True)
+    lat_index = nearest_index(lat, df["Latitude"].values, periodic=False)
+    valid = (lon_index >= 0) & (lat_index >= 0)
+    counts = np.bincount(
+        lat_index[valid] * len(lon) + lon_index[valid], minlength=len(lat) * len(lon)
+    )
+    return xr.DataArray(
+        counts.reshape(len(lat), len(lon)),
+        dims=("lat", "lon"),
+        coords={"lat": lat, "lon": lon},
+        name="occurrence_count",
+        attrs={"disease": disease},
+    )
+
+
+def _load_occurrence_columns(data_path):
+    data_path = pathlib.Path(data_path)
+    stat = data_path.stat()
+    fingerprint = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    columns = _OCCURRENCE_CACHE.get(data_path)
+    if columns is not None and np.array_equal(columns["fingerprint"], fingerprint):
+        return columns
+    cache_path = _get_cache_path(data_path)
+    columns = None
+    if cache_path.exists():
+        with np.load(cache_path) as f:
+            columns = dict(f)
+    if columns is None or not np.array_equal(columns["fingerprint"], fingerprint):
+        columns = _build_occurrence_columns(data_path, fingerprint=fingerprint)
+        with atomic_save_paths([cache_path], shared_cache=True) as (tmp_path,):
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **columns)
+    _OCCURRENCE_CACHE[data_path] = columns
+    return columns
+
+
+def _build_occurrence_columns(data_path, fingerprint):
+    print(f"Building occurrence data cache for {data_path.name}...")
+    df = pd.read_csv(data_path, dtype={**_COLUMNS, "disease": str})
+    df = df.sort_values("disease", kind="stable")
+    disease_names = np.array(sorted(df["disease"].unique()), dtype=str)
+    counts = df["disease"].value_counts().reindex(disease_names).values
+    return {
+        **{name: df[name].values.astype(dtype) for name, dtype in _COLUMNS.items()},
+        "disease_names": disease_names,
+        "disease_offsets": np.concatenate([[0], np.cumsum(counts)]),
+        "fingerprint": fingerprint,
+    }
+
+
+def _get_cache_path(data_path):
+    cache_dir = pathlib.Path(__file__).parents[1] / "results/occurrence_cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / f"{data_path.stem}.npz"
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import pathlib
+
+import numpy as np
+import xarray as xr
+
+import feature_layers
+import map_raster_cache
+import occurrence_data
+import plotting_functions
+from parallel_utils import atomic_save_paths
+
+# Cache of rendered figure panels, so that only panels whose inputs have changed are
+# re-rendered. Each call of a plotting function (which may save several panels) has an
+# entry under results/panel_cache recording a key and the names of the panels saved.
+# The key is a hash of the input data (decoded NetCDF contents and attributes, plus any
+# other input files), the plot arguments, and the plotting code (the source of
+# plotting_functions.py and its helper modules, and the render backend). If the key
+# matches and all the panels exist, the plotting function is not called again.
+
+
+def make_panels_cached(
+    plot_fn_name,
+    *,
+    data_path,
+    save_base_path,
+    extra_input_paths=(),
+    cache_name=None,
+    force=False,
+    **plot_kwargs,
+):
+    """Call a plotting function unless its panels are up to date.
+
+    plot_fn_name is the name of the function in plotting_functions. Returns "hit" or
+    "miss".
+
+    cache_name (by default the name of save_base_path) identifies the cache entry, and
+    must differ between calls saving panels with the same save_base_path.
+    """
+    save_base_path = pathlib.Path(save_base_path)
+    cache_name = cache_name or save_base_path.name
+    key = _get_key(
+        plot_fn_name,
+        data_path=data_path,
+        extra_input_paths=extra_input_paths,
+        plot_kwargs=plot_kwargs,
+    )
+    entry_path = _get_entry_path(save_base_path.parent / cache_name)
+    entry = None
+    if entry_path.exists():
+        with open(entry_path, encoding="utf-8") as f:
+            entry = json.load(f)
+    if (
+        not force
+        and entry is not None
+        and entry["key"] == key
+        and all(
+            (save_base_path.parent / name).exists() for name in entry["panel_names"]
+        )
+    ):
+        print(f"Panels for {cache_name} are up to date, skipping")
+        return "hit"
+    print(f"Making panels for {cache_name}...")
+    with plotting_functions.record_saved_paths() as saved_paths:
+        getattr(plotting_functions, plot_fn_name)(
+            data_path=data_path, save_base_path=save_base_path, **plot_kwargs
+        )
+    entry = {
+        "key": key,
+        "panel_names": [pathlib.Path(path).name for path in saved_paths],
+    }
+    with atomic_save_paths([entry_path]) as (tmp_path,):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, indent=1)
+    return "miss"
+
+
+def _get_key(plot_fn_name, data_path, extra_input_paths, plot_kwargs):
+    key_hash = hashlib.sha256()
+    for module in [
+        plotting_functions,
+        map_raster_cache,
+        feature_layers,
+        occurrence_data,
+    ]:
+        with open(module.__file__, "rb") as f:
+            key_hash.update(f.read())
+    key_hash.update(
+        json.dumps(
+            [
+                plotting_functions.get_render_backend(),
+                plot_fn_name,
+                plot_kwargs,
+            ],
+            sort_keys=True,
+            default=str,
+        ).encode()
+    )
+    _update_dataset_hash(key_hash, data_path)
+    for path in extra_input_paths:
+        with open(path, "rb") as f:
+            key_hash.update(f.read())
+    return key_hash.hexdigest()
+
+
+def _update_dataset_hash(key_hash, data_path):
+    # Hashes decoded contents rather than file bytes, so that rewriting identical data
+    # does not invalidate the cache
+    with xr.open_dataset(data_path) as ds:
+        key_hash.update(json.dumps(ds.attrs, sort_keys=True, default=str).encode())
+        for name in sorted(ds.variables):
+            variable = ds.variables[name]
+            values = variable.values
+            key_hash.update(
+                json.dumps(
+                    [name, variable.dims, str(values.dtype), variable.attrs],
+                    sort_keys=True,
+                    default=str,
+                ).encode()
+            )
+            if values.dtype.kind == "O":
+                key_hash.update(repr(values.tolist()).encode())
+            else:
+                key_hash.update(np.ascontiguousarray(values).tobytes())
+
+
+def _get_entry_path(save_base_path):
+    root = pathlib.Path(__file__).parents[1]
+    entry_path = (
+        root / "results/panel_cache" / save_base_path.relative_to(root / "figures")
+    ).with_suffix(".json")
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    return entry_path
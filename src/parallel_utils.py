@@ -0,0 +1,142 @@
+import concurrent.futures
+import contextlib
+import multiprocessing
+import os
+import pathlib
+import uuid
+
+import dask
+from tqdm import tqdm
+
+
+def run_tasks(
+    task_fn,
+    tasks,
+    workers=1,
+    task_mem_mb=None,
+    max_mem_mb=None,
+    initializer=None,
+    initargs=(),
+    return_exceptions=False,
+):
+    """Run task_fn(**task) for each task dict, optionally on a process pool.
+
+    The number of workers is capped so that workers * task_mem_mb fits in the
+    available memory (max_mem_mb if given, otherwise detected from SLURM or the OS).
+    initializer(*initargs) is called in each worker process (not when running
+    serially). Tasks are submitted in order, and the first failure cancels all pending
+    tasks and is re-raised, unless return_exceptions is True, in which case all tasks
+    run and failed tasks have their exception in place of a result. Returns the task
+    results in the same order as tasks.
+    """
+    workers = _limit_workers(workers, task_mem_mb=task_mem_mb, max_mem_mb=max_mem_mb)
+    if workers <= 1:
+        return [
+            _run_task(task_fn, task, return_exceptions=return_exceptions)
+            for task in tqdm(tasks)
+        ]
+    print(f"Running {len(tasks)} tasks on {workers} workers")
+    # Spawn rather than fork, since forking with open netCDF/HDF5 handles is unsafe
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(initializer, initargs),
+    )
+    try:
+        futures = [executor.submit(task_fn, **task) for task in tasks]
+        for future in tqdm(
+            concurrent.futures.as_completed(futures), total=len(futures)
+        ):
+            if not return_exceptions:
+                future.result()
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    return [
+        future.exception()
+        if return_exceptions and future.exception() is not None
+        else future.result()
+        for future in futures
+    ]
+
+
+@contextlib.contextmanager
+def atomic_save_paths(save_paths, shared_cache=False):
+    """Yield temporary paths to write to, moved to save_paths only on success.
+
+    On failure the temporary files are removed, so no partial output is left behind.
+    Temporary names are unique to each call, so concurrent writers of the same path
+    (e.g. several processes filling a shared cache) never touch each other's files;
+    each writer succeeds, and the last to finish replaces the others' output. If
+    shared_cache is True, failing to replace a save path that another writer has
+    already created (e.g. one held open by a reader on Windows) is also treated as
+    success, since any complete copy of a cache entry will do.
+    """
+    save_paths = [pathlib.Path(save_path) for save_path in save_paths]
+    tmp_suffix = f"{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+    tmp_paths = [
+        save_path.with_name(f".{save_path.name}.{tmp_suffix}")
+        for save_path in save_paths
+    ]
+    try:
+        yield tmp_paths
+        for tmp_path, save_path in zip(tmp_paths, save_paths):
+            try:
+                os.replace(tmp_path, save_path)
+            except OSError:
+                if not (shared_cache and save_path.exists()):
+                    raise
+    finally:
+        for tmp_path in tmp_paths:
+            tmp_path.unlink(missing_ok=True)
+
+
+def _run_task(task_fn, task, return_exceptions=False):
+    try:
+        return task_fn(**task)
+    except Exception as exc:
+        if not return_exceptions:
+            raise
+        return exc
+
+
+def _init_worker(initializer=None, initargs=()):
+    # Each worker processes one file at a time, so avoid dask spawning its own threads
+    # on top of the process pool
+    dask.config.set(scheduler="synchronous")
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _limit_workers(workers, task_mem_mb=None, max_mem_mb=None):
+    workers = max(int(workers), 1)
+    if workers == 1 or task_mem_mb is None:
+        return workers
+    if max_mem_mb is None:
+        max_mem_mb = _available_mem_mb()
+    if max_mem_mb is None:
+        return workers
+    mem_limited_workers = max(int(max_mem_mb // task_mem_mb), 1)
+    if mem_limited_workers < workers:
+        print(
+            f"Reducing workers from {workers} to {mem_limited_workers} to fit "
+            f"{task_mem_mb:.0f} MB per task in {max_mem_mb:.0f} MB of memory"
+        )
+    return min(workers, mem_limited_workers)
+
+
+def _available_mem_mb():
+    # Prefer the SLURM allocation (if running under SLURM), then free system memory
+    if "SLURM_MEM_PER_NODE" in os.environ:
+        return float(os.environ["SLURM_MEM_PER_NODE"])
+    if "SLURM_MEM_PER_CPU" in os.environ:
+        cpus = os.environ.get(
+            "SLURM_CPUS_PER_TASK", os.environ.get("SLURM_CPUS_ON_NODE", "1")
+        )
+        return float(os.environ["SLURM_MEM_PER_CPU"]) * int(cpus)
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (AttributeError, ValueError, OSError):
+        return None
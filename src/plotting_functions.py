@@ -1,36 +1,157 @@
+import atexit
+import concurrent.futures
+import contextlib
+import functools
+import os
 import pathlib
+import queue
+import shutil
+import threading
 
+import cartopy.crs as ccrs
 import climepi  # noqa
-import geoviews.feature as gf
+import geoviews as gv
 import holoviews as hv
+import hvplot
 import hvplot.pandas  # noqa
 import hvplot.xarray  # noqa
 import numpy as np
 import pandas as pd
 import xarray as xr
-from bokeh.io import export_svg
-from climepi._xcdat import BoundsAccessor, swap_lon_axis  # noqa
 from holoviews import opts
-from selenium.webdriver import Firefox, FirefoxOptions
-from selenium.webdriver.firefox.service import Service as FirefoxService
-from webdriver_manager.firefox import GeckoDriverManager
 
-WEBDRIVER_SERVICE = FirefoxService(GeckoDriverManager().install())
-WEBDRIVER_OPTIONS = FirefoxOptions()
-WEBDRIVER_OPTIONS.add_argument("--headless")
+from feature_layers import get_feature_layers
+from map_raster_cache import project_raster
+from occurrence_data import get_gridded_occurrence, load_occurrence_points
+
+# bokeh's SVG export, selenium and webdriver_manager are only imported (and the
+# geckodriver path only resolved) when a browser session is first needed
+
+RENDER_BACKENDS = ["bokeh", "matplotlib"]
+
+
+class _WebdriverPool:
+    """Pool of warm headless Firefox sessions, reused across all SVG exports.
+
+    Sessions are started lazily (up to size at once), discarded if they raise a
+    WebDriverException (and replaced by a fresh session on the next request), and
+    shut down at interpreter exit.
+    """
+
+    def __init__(self, size=1):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._n_drivers = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def driver(self):
+        from selenium.common.exceptions import WebDriverException
+
+        driver = self._acquire()
+        try:
+            yield driver
+        except WebDriverException:
+            self._discard(driver)
+            raise
+        except BaseException:
+            self._idle.put(driver)
+            raise
+        self._idle.put(driver)
+
+    def close(self):
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(driver)
+
+    def _acquire(self):
+        with self._lock:
+            start_driver = self._idle.empty() and self._n_drivers < self.size
+            if start_driver:
+                self._n_drivers += 1
+        if not start_driver:
+            return self._idle.get()
+        from selenium.webdriver import Firefox, FirefoxOptions
+        from selenium.webdriver.firefox.service import Service as FirefoxService
+
+        try:
+            options = FirefoxOptions()
+            options.add_argument("--headless")
+            return Firefox(
+                options=options, service=FirefoxService(_get_geckodriver_path())
+            )
+        except BaseException:
+            with self._lock:
+                self._n_drivers -= 1
+            raise
+
+    def _discard(self, driver):
+        from selenium.common.exceptions import WebDriverException
+
+        with contextlib.suppress(WebDriverException):
+            driver.quit()
+        with self._lock:
+            self._n_drivers -= 1
+
+
+_WEBDRIVER_POOL = _WebdriverPool()
+atexit.register(_WEBDRIVER_POOL.close)
+
+
+_RENDER_BACKEND = "bokeh"
+_SAVED_PATH_RECORDS = []
+
+
+def set_webdriver_pool_size(size):
+    """Set the number of browser sessions used to export panels concurrently."""
+    _WEBDRIVER_POOL.size = max(int(size), 1)
+
+
+def set_render_backend(backend):
+    """Set the backend used to render panels (must be called before plotting).
+
+    "bokeh" (the default) exports SVGs through a headless browser. "matplotlib" renders
+    the same panels (with the same file names) without a browser, using cartopy for
+    map features. Bokeh-style plot options are translated by hvplot.
+    """
+    global _RENDER_BACKEND
+    if backend not in RENDER_BACKENDS:
+        raise ValueError(f"Unknown render backend {backend}.")
+    if backend == "matplotlib":
+        gv.extension("matplotlib")
+        hvplot.extension("matplotlib", compatibility="bokeh")
+    _RENDER_BACKEND = backend
+
+
+def get_render_backend():
+    return _RENDER_BACKEND
+
+
+@contextlib.contextmanager
+def record_saved_paths():
+    """Record the paths of all panels saved within the context (yields a list)."""
+    saved_paths = []
+    _SAVED_PATH_RECORDS.append(saved_paths)
+    try:
+        yield saved_paths
+    finally:
+        _SAVED_PATH_RECORDS.remove(saved_paths)
 
 
 def make_current_plot(
     data_path=None,
     panel_label="A",
     save_base_path=None,
+    gridded_occurrence=False,
     **plot_kwargs,
 ):
-    plot_opts = {
-        **_get_plot_opts(map_plot=True, title_offset=-90),
-        "colorbar_position": "left",
-    }
-    plot_opts["backend_opts"]["plot.min_border_left"] = 0
+    plot_opts = _get_plot_opts(map_plot=True, title_offset=-90)
+    if _RENDER_BACKEND == "bokeh":
+        plot_opts["colorbar_position"] = "left"
+        plot_opts["backend_opts"]["plot.min_border_left"] = 0
     ds = xr.open_dataset(data_path)
     before_year_range = ds.attrs["before_year_range"]
     p = _make_map_plot(
@@ -43,9 +164,17 @@ def make_current_plot(
         },
     )
     p = p.opts(opts.Image(**plot_opts), clone=True)
-    # Plot (thinned) occurrence data from https://doi.org/10.1038/s41467-025-58609-5
-    df = pd.read_csv(pathlib.Path(__file__).parents[1] / "data/arbo_occ_thinned.csv")
-    df = df[df["disease"] == "dengue"]
+    # Plot (thinned) occurrence data from https://doi.org/10.1038/s41467-025-58609-5,
+    # either as points or (for large datasets) as the centres of grid cells with any
+    # occurrences
+    if gridded_occurrence:
+        da_count = get_gridded_occurrence(ds.lon.values, ds.lat.values)
+        df = da_count.where(da_count > 0).to_dataframe().dropna().reset_index()
+        df = pd.DataFrame(
+            {"Longitude": (df["lon"] + 180) % 360 - 180, "Latitude": df["lat"]}
+        )
+    else:
+        df = load_occurrence_points("dengue")
     p *= df.hvplot.points(x="Longitude", y="Latitude", color="red", size=0.5)
     save_path = f"{save_base_path}.svg"
     _save_fig(p, save_path=save_path)
@@ -95,9 +224,7 @@ def make_temperature_time_series_plot(
                 **plot_kwargs,
             },
         )
-        * hv.VLine(ds.time.values[20]).opts(
-            line_color="black", line_dash="dashed", clone=True
-        )
+        * _make_vline(ds.time.values[20])
     )
     p = p.opts(**plot_opts, clone=True)
     save_path = f"{save_base_path}.svg"
@@ -178,17 +305,18 @@ def make_mean_plots(
         },
     )
     p4 = p4.opts(opts.Image(**plot_opts), clone=True)
-    for plot, name in zip(
+    _save_figs(
         [p1, p2, p3, p4],
-        [
-            "before",
-            "without_intervention_minus_before",
-            "with_intervention_minus_before",
-            "with_minus_without_intervention",
+        save_paths=[
+            f"{save_base_path}_{name}.svg"
+            for name in [
+                "before",
+                "without_intervention_minus_before",
+                "with_intervention_minus_before",
+                "with_minus_without_intervention",
+            ]
         ],
-    ):
-        save_path = f"{save_base_path}_{name}.svg"
-        _save_fig(plot, save_path=save_path)
+    )
 
 
 def make_change_example_plots(
@@ -230,10 +358,13 @@ def make_change_example_plots(
         )
         p_curr = p_curr.opts(opts.Image(**plot_opts), clone=True)
         p_ex_list.append(p_curr)
-    for plot, realization in zip(p_ex_list, realizations):
-        member_id = f"{realization + 1:03d}"
-        save_path = f"{save_base_path}_ID_{member_id}.svg"
-        _save_fig(plot, save_path=save_path)
+    _save_figs(
+        p_ex_list,
+        save_paths=[
+            f"{save_base_path}_ID_{realization + 1:03d}.svg"
+            for realization in realizations
+        ],
+    )
 
 
 def make_location_example_plots(
@@ -251,112 +382,249 @@ def make_location_example_plots(
         "ylabel": "Days suitable for transmission",
     }
     ds = xr.open_dataset(data_path)
-    ds_before = ds[["before", "before_trend"]].rename(
-        time_before="time", realization_before="realization"
-    )
-    ds_after = ds[["after", "after_trend"]]
     if locations is None:
         locations = ds.location.values.tolist()
     if panel_labels is None:
         panel_labels = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")[: len(locations)]
     colors = hv.Cycle().values
+    # Lines for all locations are prepared at once. Feedback realizations r and r + 5
+    # are derived from control realization r, and each "after" line starts from the
+    # end of the "before" line it is derived from.
+    n_before = ds.sizes["realization_before"]
+    time_before = ds.time_before.values
+    time_after = np.concatenate([time_before[-1:], ds.time.values])
+    before = ds["before"].transpose("location", "realization_before", "time_before")
+    after = ds["after"].transpose("location", "realization", "time")
+    after_trend = ds["after_trend"].transpose("location", "realization", "time")
+    after_lines = np.concatenate(
+        [before.values[:, ds.realization.values % n_before, -1:], after.values],
+        axis=2,
+    )
+    highlight = (
+        None if highlight_realization is None else highlight_realization % n_before
+    )
     p_list = []
     for location, panel_label in zip(locations, panel_labels):
-        p_curr = hv.VLine(ds.time.values[0]).opts(
-            line_color="black", line_dash="dashed", clone=True
-        )
-        for realization in range(5):
-            realization_pair = [realization, (realization + 5) % 10]
-            member_id_pair = [f"{x + 1:03d}" for x in realization_pair]
-            highlight = highlight_realization in realization_pair
-            before_plot_kwargs = {
-                **plot_kwargs,
-                "color": colors[6] if highlight else "grey",
-                **({"line_width": 1, "alpha": 0.75} if not highlight else {}),
-            }
-            ds_before_curr = ds_before.sel(realization=realization, location=location)
-            p_curr *= ds_before_curr.climepi.plot_time_series(
-                "before", **before_plot_kwargs
-            ).opts(title=f"{panel_label}. {location}", **plot_opts, clone=True)
-            if highlight:
-                p_curr *= ds_before_curr.climepi.plot_time_series(
-                    "before", **{"line_dash": "dashed", **before_plot_kwargs}
+        i = ds.location.values.tolist().index(location)
+        # Non-highlighted lines are drawn as a single multi-line glyph on either side of
+        # the highlighted lines (preserving the order in which realizations are drawn)
+        grey_lines = {"below": [], "above": []}
+        for realization in range(n_before):
+            if realization == highlight:
+                continue
+            group = "below" if highlight is None or realization < highlight else "above"
+            grey_lines[group].append(
+                (time_before, before.values[i, realization], 1, 0.75)
+            )
+            for realization_ in [realization, realization + n_before]:
+                grey_lines[group].append(
+                    (time_after, after_lines[i, realization_], 0.5, 1)
                 )
-            for realization_, member_id_, color in zip(
-                realization_pair,
-                member_id_pair,
-                ([colors[0], colors[1]] if highlight else ["grey", "grey"]),
+        elements = [_make_vline(ds.time.values[0])]
+        if grey_lines["below"]:
+            elements.append(_make_line_collection(grey_lines["below"], color="grey"))
+        if highlight is not None:
+            elements.append(
+                _make_line(time_before, before.values[i, highlight], color=colors[6])
+            )
+            for realization_, color in zip(
+                [highlight, highlight + n_before], [colors[0], colors[1]]
             ):
-                ds_after_curr = ds_after.sel(
-                    realization=realization_, location=location
-                )
-                after_plot_kwargs = {
-                    **plot_kwargs,
-                    "color": color,
-                    **(
-                        {"line_width": 0.5}
-                        if not highlight
-                        else {"label": f"ID {member_id_}"}
-                    ),
-                }
-                p_curr *= (
-                    xr.concat(
-                        [
-                            ds_before_curr["before"].isel(time=-1),
-                            ds_after_curr["after"],
-                        ],
-                        dim="time",
-                        coords="minimal",
-                        compat="override",
+                elements.append(
+                    _make_line(
+                        time_after,
+                        after_lines[i, realization_],
+                        color=color,
+                        label=f"ID {realization_ + 1:03d}",
                     )
-                    .to_dataset()
-                    .climepi.plot_time_series(**after_plot_kwargs)
                 )
-                if highlight:
-                    after_trend_plot_kwargs = {
-                        "line_dash": "dashed",
-                        **{k: v for k, v in after_plot_kwargs.items() if k != "label"},
-                    }
-                    p_curr *= ds_after_curr.climepi.plot_time_series(
-                        "after_trend", **after_trend_plot_kwargs
+                elements.append(
+                    _make_line(
+                        ds.time.values,
+                        after_trend.values[i, realization_],
+                        color=color,
+                        dashed=True,
                     )
-        p_curr = p_curr.opts(legend_position="bottom_right", clone=True)
+                )
+        if grey_lines["above"]:
+            elements.append(_make_line_collection(grey_lines["above"], color="grey"))
+        p_curr = hv.Overlay(elements).opts(
+            title=f"{panel_label}. {location}",
+            legend_position="bottom_right",
+            **plot_opts,
+            **plot_kwargs,
+        )
         p_list.append(p_curr)
-    for plot, location in zip(p_list, locations):
-        save_path = f"{save_base_path}_{location.lower().replace(' ', '_')}.svg"
-        _save_fig(plot, save_path=save_path)
+    _save_figs(
+        p_list,
+        save_paths=[
+            f"{save_base_path}_{location.lower().replace(' ', '_')}.svg"
+            for location in locations
+        ],
+    )
+
+
+def _make_line(x, y, color, label="", dashed=False):
+    return hv.Curve((x, y), "time", "days_suitable", label=label).opts(
+        **_get_line_style(color=color, line_width=2, dashed=dashed), clone=True
+    )
+
+
+def _make_line_collection(lines, color):
+    # lines is a list of (x, y, line_width, alpha) tuples, drawn as one multi-line glyph
+    return hv.Path(
+        [
+            {"time": x, "days_suitable": y, "line_width": line_width, "alpha": alpha}
+            for x, y, line_width, alpha in lines
+        ],
+        kdims=["time", "days_suitable"],
+        vdims=["line_width", "alpha"],
+    ).opts(
+        **_get_line_style(
+            color=color, line_width=hv.dim("line_width"), alpha=hv.dim("alpha")
+        ),
+        clone=True,
+    )
+
+
+def _get_line_style(color, line_width=None, alpha=None, dashed=False):
+    if _RENDER_BACKEND == "bokeh":
+        line_style = {"color": color, "line_width": line_width, "alpha": alpha}
+        if dashed:
+            line_style["line_dash"] = "dashed"
+    else:
+        line_style = {"color": color, "linewidth": line_width, "alpha": alpha}
+        if dashed:
+            line_style["linestyle"] = "dashed"
+    return {key: value for key, value in line_style.items() if value is not None}
 
 
 def _make_map_plot(ds, plot_var, **kwargs):
-    ds = ds.bounds.add_missing_bounds(axes=("X",))
-    ds = swap_lon_axis(ds.reset_coords(drop=True), to=(-180, 180))
+    # Fields are projected and rasterized with a cached mapping from grid cells to
+    # pixels (see map_raster_cache.py), rather than by hvplot for each field
+    projection = ccrs.PlateCarree()
+    da = project_raster(ds[plot_var], projection=projection)
     kwargs_hvplot = {
-        "x": "lon",
-        "y": "lat",
+        "x": "x",
+        "y": "y",
         "cmap": "viridis",
         "geo": True,
+        "crs": projection,
+        "projection": projection,
         "global_extent": True,
-        "rasterize": True,
-        "features": ["borders", "coastline"],
         "dynamic": False,
-        "project": True,
         **kwargs,
     }
+    # Feature layers are loaded and projected once, and shared between maps
+    feature_layers = get_feature_layers(projection)
+    fill_opts = (
+        {"fill_color": "white"}
+        if _RENDER_BACKEND == "bokeh"
+        else {"facecolor": "white", "edgecolor": "none"}
+    )
     return (
-        ds[plot_var].hvplot.image(**kwargs_hvplot)
-        * gf.ocean(fill_color="white")
-        * gf.lakes(fill_color="white")
+        da.hvplot.image(**kwargs_hvplot)
+        * feature_layers["borders"]
+        * feature_layers["coastline"]
+        * feature_layers["ocean"].opts(**fill_opts, clone=True)
+        * feature_layers["lakes"].opts(**fill_opts, clone=True)
+    )
+
+
+def _make_vline(x):
+    line_opts = (
+        {"line_color": "black", "line_dash": "dashed"}
+        if _RENDER_BACKEND == "bokeh"
+        else {"color": "black", "linestyle": "dashed"}
     )
+    return hv.VLine(x).opts(**line_opts, clone=True)
 
 
 def _save_fig(plot, save_path=None):
-    with Firefox(options=WEBDRIVER_OPTIONS, service=WEBDRIVER_SERVICE) as driver:
+    _save_figs([plot], save_paths=[save_path])
+
+
+def _save_figs(plots, save_paths=None):
+    if _RENDER_BACKEND == "matplotlib":
+        _save_figs_matplotlib(plots, save_paths=save_paths)
+    else:
+        _save_figs_bokeh(plots, save_paths=save_paths)
+    for saved_paths in _SAVED_PATH_RECORDS:
+        saved_paths.extend(str(save_path) for save_path in save_paths)
+
+
+def _save_figs_matplotlib(plots, save_paths=None):
+    renderer = hv.renderer("matplotlib")
+    for plot, save_path in zip(plots, save_paths):
+        renderer.save(plot, str(pathlib.Path(save_path).with_suffix("")), fmt="svg")
+
+
+def _save_figs_bokeh(plots, save_paths=None):
+    # Plots are rendered in turn, then exported concurrently on the webdriver pool
+    bokeh_plots = []
+    for plot in plots:
         bokeh_plot = hv.render(plot, backend="bokeh")
         bokeh_plot.sizing_mode = None  # stops warnings about width/height not being set
-        export_svg(bokeh_plot, filename=save_path, webdriver=driver)
+        bokeh_plots.append(bokeh_plot)
+    if len(bokeh_plots) == 1 or _WEBDRIVER_POOL.size == 1:
+        for bokeh_plot, save_path in zip(bokeh_plots, save_paths):
+            _export_svg(bokeh_plot, save_path)
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=_WEBDRIVER_POOL.size
+    ) as executor:
+        for future in [
+            executor.submit(_export_svg, bokeh_plot, save_path)
+            for bokeh_plot, save_path in zip(bokeh_plots, save_paths)
+        ]:
+            future.result()
+
+
+def _export_svg(bokeh_plot, save_path):
+    from bokeh.io import export_svg
+    from selenium.common.exceptions import WebDriverException
+
+    # Retries once on a fresh session if the browser session crashes
+    try:
+        with _WEBDRIVER_POOL.driver() as driver:
+            export_svg(bokeh_plot, filename=save_path, webdriver=driver)
+    except WebDriverException:
+        with _WEBDRIVER_POOL.driver() as driver:
+            export_svg(bokeh_plot, filename=save_path, webdriver=driver)
+
+
+@functools.cache
+def _get_geckodriver_path():
+    # Avoids network access where possible, using (in order) the GECKODRIVER_PATH
+    # environment variable, the path saved by a previous run, geckodriver on the PATH,
+    # and finally webdriver_manager (which may download a driver)
+    path = os.environ.get("GECKODRIVER_PATH")
+    if path:
+        return path
+    saved_path_file = (
+        pathlib.Path(__file__).parents[1] / "results/webdriver/geckodriver_path.txt"
+    )
+    if saved_path_file.exists():
+        with open(saved_path_file, encoding="utf-8") as f:
+            path = f.read().strip()
+        if pathlib.Path(path).exists():
+            return path
+    path = shutil.which("geckodriver")
+    if path is None:
+        from webdriver_manager.firefox import GeckoDriverManager
+
+        path = GeckoDriverManager().install()
+    saved_path_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(saved_path_file, "w", encoding="utf-8") as f:
+        f.write(path)
+    return path
 
 
 def _get_plot_opts(extra_title_offset=False, map_plot=False, title_offset=None):
+    if _RENDER_BACKEND == "matplotlib":
+        return _get_plot_opts_matplotlib(
+            extra_title_offset=extra_title_offset, map_plot=map_plot
+        )
     title_offset = title_offset or (-65 if extra_title_offset else -15)
     plot_opts = {
         "frame_width": 500,
@@ -383,3 +651,17 @@ def _get_plot_opts(extra_title_offset=False, map_plot=False, title_offset=None):
         plot_opts["xaxis"] = None
         plot_opts["yaxis"] = None
     return plot_opts
+
+
+def _get_plot_opts_matplotlib(extra_title_offset=False, map_plot=False):
+    # Figure sizes (in points, so that SVG sizes match the bokeh panels in px) follow
+    # the panel sizes used when combining panels in make_figures.py
+    panel_width, panel_height = (580, 330) if extra_title_offset else (620, 285)
+    plot_opts = {
+        "fig_inches": (panel_width / 72, panel_height / 72),
+        "fontsize": {"title": 14, "labels": 12, "ticks": 10},
+    }
+    if map_plot:
+        plot_opts["xaxis"] = None
+        plot_opts["yaxis"] = None
+    return plot_opts
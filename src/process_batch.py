@@ -0,0 +1,259 @@
+import argparse
+import functools
+import itertools
+
+import dask
+import numpy as np
+import xarray as xr
+
+from calc_mean_temperatures import (
+    MEAN_TEMPERATURE_MEM_OVERHEAD,
+    _calc_mean_temperature,
+    _get_mean_temperature_save_dir,
+    _spatial_mean_temperature,
+)
+from epi_store import write_epi_store_region
+from inputs import DATASETS, EPI_MODELS
+from parallel_utils import atomic_save_paths, run_tasks
+from run_epi_model import (
+    EPI_MODEL_MEM_OVERHEAD,
+    _check_lookup_engine,
+    _data_path,
+    _estimate_mem_mb,
+    _get_epi_save_dir,
+    _open_climate_data,
+    _open_climate_data_multi_year,
+    _run_yearly_portion_suitable,
+)
+
+
+def _process_batch(
+    dataset=None,
+    years=None,
+    realizations=None,
+    epi_model_names=None,
+    workers=1,
+    engine="climepi",
+    output_format="netcdf",
+    multi_year=False,
+):
+    # Mean temperatures and epi model results from a single read of each climate file.
+    # With multi_year, all years of each realization are processed as one
+    # time-concatenated dataset, so that the models are run once per realization.
+    subset_all = DATASETS[dataset]["subset"]
+    if years is None:
+        years = subset_all["years"]
+    if realizations is None:
+        realizations = subset_all["realizations"]
+    if epi_model_names is None:
+        epi_model_names = EPI_MODELS
+    years = np.atleast_1d(years)
+    realizations = np.atleast_1d(realizations)
+
+    mean_temperature_save_dir = _get_mean_temperature_save_dir(dataset)
+    epi_save_dirs = {
+        epi_model_name: _get_epi_save_dir(
+            dataset=dataset, epi_model_name=epi_model_name
+        )
+        for epi_model_name in epi_model_names
+    }
+
+    if engine == "lookup":
+        ds_clim_first = _open_climate_data(
+            _data_path(dataset=dataset, realization=realizations[0], year=years[0])
+        )
+        for epi_model_name in epi_model_names:
+            _check_lookup_engine(ds_clim_first, epi_model_name=epi_model_name)
+
+    file_mem_mb = _estimate_mem_mb(
+        _data_path(dataset=dataset, realization=realizations[0], year=years[0]),
+        overhead_factor=MEAN_TEMPERATURE_MEM_OVERHEAD + EPI_MODEL_MEM_OVERHEAD,
+    )
+    if multi_year:
+        task_fn = _process_realization
+        tasks = [
+            {"realization": realization, "years": years} for realization in realizations
+        ]
+        task_mem_mb = file_mem_mb * len(years)
+    else:
+        task_fn = _process_file
+        tasks = [
+            {"realization": realization, "year": year}
+            for year, realization in itertools.product(years, realizations)
+        ]
+        task_mem_mb = file_mem_mb
+    results = run_tasks(
+        functools.partial(
+            task_fn,
+            dataset=dataset,
+            epi_model_names=epi_model_names,
+            mean_temperature_save_dir=mean_temperature_save_dir,
+            epi_save_dirs=epi_save_dirs if output_format == "netcdf" else None,
+            engine=engine,
+        ),
+        tasks,
+        workers=workers,
+        task_mem_mb=task_mem_mb,
+    )
+    if output_format == "zarr":
+        for epi_model_name in epi_model_names:
+            write_epi_store_region(
+                [ds_epi_dict[epi_model_name] for ds_epi_dict in results],
+                dataset=dataset,
+                epi_model_name=epi_model_name,
+            )
+
+
+def _process_file(
+    *,
+    dataset,
+    realization,
+    year,
+    epi_model_names,
+    mean_temperature_save_dir,
+    epi_save_dirs=None,
+    engine="climepi",
+):
+    # If epi_save_dirs is None, the computed epi model results are returned (keyed by
+    # model name) rather than saved
+    data_path = _data_path(dataset=dataset, realization=realization, year=year)
+    ds_clim = _open_climate_data(data_path).load()
+    ds_mean = _calc_mean_temperature(ds_clim)
+    ds_epi_dict = {
+        epi_model_name: _run_yearly_portion_suitable(
+            ds_clim, epi_model_name=epi_model_name, engine=engine
+        )
+        for epi_model_name in epi_model_names
+    }
+    save_paths = [mean_temperature_save_dir / f"{realization}_{year}.nc"]
+    datasets_out = [ds_mean]
+    if epi_save_dirs is not None:
+        save_paths += [
+            epi_save_dirs[epi_model_name] / f"{realization}_{year}.nc"
+            for epi_model_name in epi_model_names
+        ]
+        datasets_out += [
+            ds_epi_dict[epi_model_name] for epi_model_name in epi_model_names
+        ]
+    with atomic_save_paths(save_paths) as tmp_paths:
+        for ds_out, tmp_path in zip(datasets_out, tmp_paths):
+            ds_out.to_netcdf(tmp_path)
+    if epi_save_dirs is None:
+        return ds_epi_dict
+
+
+def _process_realization(
+    *,
+    dataset,
+    realization,
+    years,
+    epi_model_names,
+    mean_temperature_save_dir,
+    epi_save_dirs=None,
+    engine="climepi",
+):
+    # Splits the multi-year output back into the per-year files written by
+    # _process_file (or returns the epi model results if epi_save_dirs is None). The
+    # spatial mean and all epi models are computed together, so each file is read once.
+    data_paths = [
+        _data_path(dataset=dataset, realization=realization, year=year)
+        for year in years
+    ]
+    ds_clim = _open_climate_data_multi_year(data_paths)
+    ds_spatial_mean, ds_epi_dict = dask.compute(
+        _spatial_mean_temperature(ds_clim),
+        {
+            epi_model_name: _run_yearly_portion_suitable(
+                ds_clim, epi_model_name=epi_model_name, engine=engine
+            )
+            for epi_model_name in epi_model_names
+        },
+    )
+    ds_mean = ds_spatial_mean.climepi.yearly_average()
+    save_paths = []
+    datasets_out = []
+    split_items = [(mean_temperature_save_dir, ds_mean)]
+    if epi_save_dirs is not None:
+        split_items += [
+            (epi_save_dirs[epi_model_name], ds_epi_dict[epi_model_name])
+            for epi_model_name in epi_model_names
+        ]
+    for save_dir, ds_out in split_items:
+        years_out, datasets_year = zip(*ds_out.groupby("time.year"))
+        if sorted(years_out) != sorted(years.tolist()):
+            raise ValueError(
+                f"Output years {list(years_out)} do not match the requested years "
+                f"{years.tolist()}."
+            )
+        save_paths += [save_dir / f"{realization}_{year}.nc" for year in years_out]
+        datasets_out += datasets_year
+    with atomic_save_paths(save_paths) as tmp_paths:
+        xr.save_mfdataset(datasets_out, tmp_paths)
+    if epi_save_dirs is None:
+        return ds_epi_dict
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calculate mean temperatures and run epi models"
+    )
+    parser.add_argument("--dataset", type=str, required=True, help="Dataset name")
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Years to process",
+    )
+    parser.add_argument(
+        "--realizations",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Realizations to process",
+    )
+    parser.add_argument(
+        "--epi-model-names",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Epi models to run (defaults to all models in EPI_MODELS)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of files to process in parallel (capped to fit in memory)",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["climepi", "lookup"],
+        default="climepi",
+        help="Engine used to evaluate the epi models (lookup is faster, niche models "
+        "only)",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=["netcdf", "zarr"],
+        default="netcdf",
+        help="Write per-year epi model NetCDF files, or a region of the (initialized) "
+        "Zarr store",
+    )
+    parser.add_argument(
+        "--multi-year",
+        action="store_true",
+        help="Process all years of each realization in a single call",
+    )
+    args = parser.parse_args()
+    _process_batch(
+        dataset=args.dataset,
+        years=args.years,
+        realizations=args.realizations,
+        epi_model_names=args.epi_model_names,
+        workers=args.workers,
+        engine=args.engine,
+        output_format=args.output_format,
+        multi_year=args.multi_year,
+    )
@@ -0,0 +1,92 @@
+import pathlib
+
+import numpy as np
+import xarray as xr
+from tqdm import tqdm
+
+from parallel_utils import atomic_save_paths
+
+# Cache of per-file partial reductions of epi model results, used to build window means
+# without re-reading every result file. For each {realization}_{year}.nc file the cache
+# holds the sum and count (over time) of portion_suitable for each grid cell, stacked
+# along a "file" dimension with realization, year and file fingerprint (name, size,
+# mtime) coordinates. Only new or changed files are re-read when the cache is loaded.
+
+_FINGERPRINT_COORDS = ["file_name", "file_size", "file_mtime_ns"]
+
+
+def load_reduction_cache(dataset=None, epi_model_name=None):
+    result_dir = (
+        pathlib.Path(__file__).parents[1] / f"results/{epi_model_name}/{dataset}"
+    )
+    cache_path = _get_cache_path(dataset=dataset, epi_model_name=epi_model_name)
+    file_stats = {path.name: path.stat() for path in sorted(result_dir.glob("*.nc"))}
+    if not file_stats:
+        raise ValueError(f"No epi model results found in {result_dir}.")
+
+    ds_cache = None
+    n_removed = 0
+    if cache_path.exists():
+        with xr.open_dataset(cache_path) as ds:
+            ds_cache = ds.load()
+        is_current = np.array(
+            [
+                name in file_stats
+                and file_stats[name].st_size == size
+                and file_stats[name].st_mtime_ns == mtime_ns
+                for name, size, mtime_ns in zip(
+                    *(ds_cache[coord].values for coord in _FINGERPRINT_COORDS)
+                )
+            ],
+            dtype=bool,
+        )
+        n_removed = int((~is_current).sum())
+        ds_cache = ds_cache.isel(file=is_current)
+    cached_names = set() if ds_cache is None else set(ds_cache.file_name.values)
+    new_names = [name for name in file_stats if name not in cached_names]
+    if ds_cache is not None and not new_names and not n_removed:
+        return ds_cache
+
+    print(f"Updating reduction cache with {len(new_names)} new or changed files...")
+    datasets_partial = [
+        _get_file_partials(result_dir / name, file_stats[name])
+        for name in tqdm(new_names)
+    ]
+    if ds_cache is not None and ds_cache.sizes["file"]:
+        datasets_partial.insert(0, ds_cache)
+    ds_cache = xr.concat(datasets_partial, dim="file")
+    ds_cache = ds_cache.isel(file=np.argsort(ds_cache.file_name.values))
+    with atomic_save_paths([cache_path]) as (tmp_path,):
+        ds_cache.to_netcdf(tmp_path)
+    return ds_cache
+
+
+def _get_file_partials(path, stat):
+    realization, year = (int(x) for x in path.stem.split("_"))
+    with xr.open_dataset(path) as ds:
+        da = ds["portion_suitable"].load()
+    ds_partial = xr.Dataset(
+        {
+            "portion_suitable_sum": da.sum(dim="time"),
+            "portion_suitable_count": da.count(dim="time"),
+        }
+    ).squeeze(drop=True)
+    return (
+        ds_partial.reset_coords(drop=True)
+        .expand_dims("file")
+        .assign_coords(
+            realization=("file", [realization]),
+            year=("file", [year]),
+            file_name=("file", [path.name]),
+            file_size=("file", [stat.st_size]),
+            file_mtime_ns=("file", [stat.st_mtime_ns]),
+        )
+    )
+
+
+def _get_cache_path(dataset=None, epi_model_name=None):
+    cache_dir = (
+        pathlib.Path(__file__).parents[1] / f"results/reduction_cache/{epi_model_name}"
+    )
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / f"{dataset}.nc"
@@ -1,13 +1,34 @@
 import argparse
+import functools
 import itertools
 import pathlib
 
 import numpy as np
 import xarray as xr
 from climepi import epimod
-from tqdm import tqdm
 
-from inputs import DATASETS
+from data_index import get_data_path
+from epi_store import init_epi_store, write_epi_store_region
+from inputs import DATASETS, EPI_MODELS
+from parallel_utils import atomic_save_paths, run_tasks
+
+# Approximate peak memory use when running an epi model on a file, as a multiple of
+# the file's decoded size (accounts for intermediate arrays in the model run)
+EPI_MODEL_MEM_OVERHEAD = 4
+
+# Settings for the lookup engine, which tabulates each model's temperature-suitability
+# curve once on a fine uniform grid (in °C) and applies it by nearest-grid-point
+# lookup. Only the (temperature-only) Mordecai niche models are supported. Lookup
+# engine results are checked against climepi on the first file of each run. The
+# nearest grid point is within half a step of the temperature, so unless a day's
+# temperature is within one step of a change in the tabulated suitability (a model
+# threshold), both engines see the same side of every threshold and agree exactly. Each
+# day near a threshold can change the yearly count by at most one day, so results must
+# agree to within that number of days, for each grid cell and year.
+LOOKUP_EPI_MODEL_NAMES = EPI_MODELS
+LOOKUP_TEMPERATURE_MIN = -100
+LOOKUP_TEMPERATURE_MAX = 70
+LOOKUP_TEMPERATURE_STEP = 0.001
 
 
 def _run_epi_model(
@@ -15,6 +36,9 @@ def _run_epi_model(
     years=None,
     realizations=None,
     epi_model_name=None,
+    workers=1,
+    engine="climepi",
+    output_format="netcdf",
 ):
     if epi_model_name is None:
         raise ValueError("epi_model_name must be provided.")
@@ -26,31 +50,227 @@ def _run_epi_model(
     years = np.atleast_1d(years)
     realizations = np.atleast_1d(realizations)
 
-    epi_model = epimod.get_example_model(epi_model_name)
+    save_dir = _get_epi_save_dir(dataset=dataset, epi_model_name=epi_model_name)
+    first_data_path = _data_path(
+        dataset=dataset, realization=realizations[0], year=years[0]
+    )
+    file_mem_mb = _estimate_mem_mb(
+        first_data_path, overhead_factor=EPI_MODEL_MEM_OVERHEAD
+    )
+    if engine == "lookup":
+        _check_lookup_engine(
+            _open_climate_data(first_data_path), epi_model_name=epi_model_name
+        )
+
+    results = run_tasks(
+        functools.partial(
+            _run_epi_model_file,
+            dataset=dataset,
+            epi_model_name=epi_model_name,
+            save_dir=save_dir if output_format == "netcdf" else None,
+            engine=engine,
+        ),
+        [
+            {"realization": realization, "year": year}
+            for year, realization in itertools.product(years, realizations)
+        ],
+        workers=workers,
+        task_mem_mb=file_mem_mb,
+    )
+    if output_format == "zarr":
+        write_epi_store_region(results, dataset=dataset, epi_model_name=epi_model_name)
+
+
+def _run_epi_model_file(
+    *, dataset, realization, year, epi_model_name, save_dir=None, engine="climepi"
+):
+    # If save_dir is None, returns the computed result rather than saving it
+    data_path = _data_path(dataset=dataset, realization=realization, year=year)
+    ds_clim = _open_climate_data(data_path)
+    ds_epi = _run_yearly_portion_suitable(
+        ds_clim, epi_model_name=epi_model_name, engine=engine
+    )
+    if save_dir is None:
+        return ds_epi.compute()
+    with atomic_save_paths([save_dir / f"{realization}_{year}.nc"]) as (tmp_path,):
+        ds_epi.to_netcdf(tmp_path)
+
+
+def _init_epi_store(dataset=None, epi_model_name=None, engine="climepi"):
+    # Uses the result for the first year and realization as the store template
+    subset_all = DATASETS[dataset]["subset"]
+    data_path = _data_path(
+        dataset=dataset,
+        realization=subset_all["realizations"][0],
+        year=subset_all["years"][0],
+    )
+    ds_epi = _run_yearly_portion_suitable(
+        _open_climate_data(data_path), epi_model_name=epi_model_name, engine=engine
+    )
+    init_epi_store(ds_epi.compute(), dataset=dataset, epi_model_name=epi_model_name)
+
+
+def _run_yearly_portion_suitable(ds_clim, *, epi_model_name, engine="climepi"):
+    if engine == "climepi":
+        return _get_epi_model(epi_model_name).run(
+            ds_clim, return_yearly_portion_suitable=True
+        )
+    if engine == "lookup":
+        return _run_lookup_engine(ds_clim, epi_model_name=epi_model_name)
+    raise ValueError(f"Unknown epi model engine '{engine}'.")
+
+
+@functools.cache
+def _get_epi_model(epi_model_name):
+    return epimod.get_example_model(epi_model_name)
+
+
+def _run_lookup_engine(ds_clim, *, epi_model_name):
+    suitability_var_name, suitability_values = _get_suitability_lookup(epi_model_name)
+    da_suitability = xr.apply_ufunc(
+        _lookup_suitability,
+        ds_clim["temperature"],
+        kwargs={"suitability_values": suitability_values},
+        dask="parallelized",
+        output_dtypes=[np.float64],
+    )
+    ds_suitability = ds_clim.drop_vars("temperature").assign(
+        {suitability_var_name: da_suitability}
+    )
+    # Aggregate with climepi so that the output matches EpiModel.run
+    return ds_suitability.climepi.yearly_portion_suitable()
+
+
+@functools.cache
+def _get_suitability_lookup(epi_model_name):
+    # Evaluates the climepi model once on the lookup temperature grid
+    if epi_model_name not in LOOKUP_EPI_MODEL_NAMES:
+        raise ValueError(
+            f"The lookup engine is only available for {LOOKUP_EPI_MODEL_NAMES}."
+        )
+    grid_range = LOOKUP_TEMPERATURE_MAX - LOOKUP_TEMPERATURE_MIN
+    temperature_grid = LOOKUP_TEMPERATURE_MIN + LOOKUP_TEMPERATURE_STEP * np.arange(
+        round(grid_range / LOOKUP_TEMPERATURE_STEP) + 1
+    )
+    ds_grid = xr.Dataset({"temperature": ("temperature_grid", temperature_grid)})
+    ds_suitability = _get_epi_model(epi_model_name).run(ds_grid)
+    (suitability_var_name,) = ds_suitability.data_vars
+    suitability_values = ds_suitability[suitability_var_name].values.astype(np.float64)
+    return suitability_var_name, suitability_values
+
+
+def _lookup_suitability(temperature, suitability_values):
+    # The grid is uniform, so the nearest grid point is found directly rather than by
+    # searching (missing temperatures give missing suitability, as in climepi)
+    index = np.rint((temperature - LOOKUP_TEMPERATURE_MIN) / LOOKUP_TEMPERATURE_STEP)
+    index = np.clip(np.nan_to_num(index), 0, len(suitability_values) - 1)
+    return np.where(
+        np.isnan(temperature), np.nan, suitability_values[index.astype(np.int64)]
+    )
+
 
+def _check_lookup_engine(ds_clim, *, epi_model_name):
+    ds_climepi = _run_yearly_portion_suitable(
+        ds_clim, epi_model_name=epi_model_name, engine="climepi"
+    ).compute()
+    ds_lookup = _run_yearly_portion_suitable(
+        ds_clim, epi_model_name=epi_model_name, engine="lookup"
+    ).compute()
+    # Days near a threshold, per grid cell and year (aggregated as for suitability)
+    suitability_var_name, suitability_values = _get_suitability_lookup(epi_model_name)
+    change_index = np.flatnonzero(np.diff(suitability_values))
+    change_temperatures = np.concatenate(
+        [
+            [-np.inf],
+            LOOKUP_TEMPERATURE_MIN + LOOKUP_TEMPERATURE_STEP * (change_index + 0.5),
+            [np.inf],
+        ]
+    )
+    da_near_threshold = xr.apply_ufunc(
+        _near_threshold,
+        ds_clim["temperature"],
+        kwargs={"change_temperatures": change_temperatures},
+        dask="parallelized",
+        output_dtypes=[np.float64],
+    )
+    ds_tolerance = (
+        ds_clim.drop_vars("temperature")
+        .assign({suitability_var_name: da_near_threshold})
+        .climepi.yearly_portion_suitable()
+        .compute()
+    )
+    for var_name in ds_climepi.data_vars:
+        if str(var_name).endswith("_bnds"):
+            continue
+        da_climepi, da_lookup, da_tolerance = xr.align(
+            ds_climepi[var_name],
+            ds_lookup[var_name],
+            ds_tolerance[var_name],
+            join="exact",
+        )
+        da_diff = np.abs(da_lookup - da_climepi)
+        max_diff = float(da_diff.max())
+        max_tolerance = float(da_tolerance.max())
+        print(
+            f"Lookup engine check for {epi_model_name}: max difference in {var_name} "
+            f"is {max_diff:.3g} days (at most {max_tolerance:.3g} days near a "
+            "threshold in any grid cell and year)"
+        )
+        if (da_diff > da_tolerance + 1e-9).any():
+            raise ValueError(
+                f"Lookup engine result for {var_name} differs from climepi by more "
+                "than the number of days near a model threshold (max difference "
+                f"{max_diff:.3g} days)."
+            )
+
+
+def _near_threshold(temperature, change_temperatures):
+    # Whether each temperature is within one lookup grid step of a change in the table
+    # (change_temperatures is sorted and padded with infinities at both ends)
+    index = np.clip(
+        np.searchsorted(change_temperatures, temperature),
+        1,
+        len(change_temperatures) - 1,
+    )
+    distance = np.minimum(
+        temperature - change_temperatures[index - 1],
+        change_temperatures[index] - temperature,
+    )
+    return (distance <= LOOKUP_TEMPERATURE_STEP).astype(np.float64)
+
+
+def _get_epi_save_dir(dataset, epi_model_name):
     save_dir = pathlib.Path(__file__).parents[1] / f"results/{epi_model_name}/{dataset}"
     save_dir.mkdir(parents=True, exist_ok=True)
+    return save_dir
+
+
+def _open_climate_data(data_path):
+    ds_clim = xr.open_dataset(data_path, chunks={})
+    ds_clim.time_bnds.load()  # Load time bounds to avoid encoding issues
+    return ds_clim
+
+
+def _open_climate_data_multi_year(data_paths):
+    ds_clim = xr.open_mfdataset(
+        data_paths,
+        chunks={},
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    )
+    ds_clim.time_bnds.load()  # Load time bounds to avoid encoding issues
+    return ds_clim
+
 
-    for year, realization in tqdm(
-        itertools.product(years, realizations),
-        total=len(years) * len(realizations),
-    ):
-        data_path = _data_path(dataset=dataset, realization=realization, year=year)
-        ds_clim = xr.open_dataset(data_path, chunks={})
-        ds_clim.time_bnds.load()  # Load time bounds to avoid encoding issues
-        ds_epi = epi_model.run(ds_clim, return_yearly_portion_suitable=True)
-        save_path = save_dir / f"{realization}_{year}.nc"
-        ds_epi.to_netcdf(save_path)
+def _estimate_mem_mb(data_path, overhead_factor=1):
+    # Approximate memory needed to process a file, from its decoded (in-memory) size
+    with xr.open_dataset(data_path, chunks={}) as ds:
+        return ds.nbytes * overhead_factor / 1024**2
 
 
 def _data_path(*, dataset, realization, year):
-    data_dir = DATASETS[dataset]["save_dir"]
-    if "downscaled" in dataset:
-        pattern = f"{dataset}_{realization}_{year}.nc"
-    else:
-        pattern = f"*_{year}_*_{realization}.nc"
-    (path,) = data_dir.glob(pattern)
-    return path
+    return get_data_path(dataset=dataset, realization=realization, year=year)
 
 
 if __name__ == "__main__":
@@ -76,10 +296,46 @@ if __name__ == "__main__":
         default=None,
         help="Epi model name to run",
     )
-    args = parser.parse_args()
-    _run_epi_model(
-        dataset=args.dataset,
-        years=args.years,
-        realizations=args.realizations,
-        epi_model_name=args.epi_model_name,
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of files to process in parallel (capped to fit in memory)",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["climepi", "lookup"],
+        default="climepi",
+        help="Engine used to evaluate the epi model (lookup is faster, niche models "
+        "only)",
     )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=["netcdf", "zarr"],
+        default="netcdf",
+        help="Write per-year NetCDF files, or a region of the (initialized) Zarr store",
+    )
+    parser.add_argument(
+        "--init-zarr-store",
+        action="store_true",
+        help="Only initialize the Zarr store for the dataset and epi model",
+    )
+    args = parser.parse_args()
+    if args.init_zarr_store:
+        _init_epi_store(
+            dataset=args.dataset,
+            epi_model_name=args.epi_model_name,
+            engine=args.engine,
+        )
+    else:
+        _run_epi_model(
+            dataset=args.dataset,
+            years=args.years,
+            realizations=args.realizations,
+            epi_model_name=args.epi_model_name,
+            workers=args.workers,
+            engine=args.engine,
+            output_format=args.output_format,
+        )
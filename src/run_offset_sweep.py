@@ -0,0 +1,266 @@
+import argparse
+import functools
+import itertools
+import pathlib
+
+import climepi  # noqa
+import numpy as np
+import xarray as xr
+
+from inputs import DATASETS
+from parallel_utils import atomic_save_paths, run_tasks
+from run_epi_model import (
+    EPI_MODEL_MEM_OVERHEAD,
+    LOOKUP_EPI_MODEL_NAMES,
+    LOOKUP_TEMPERATURE_MIN,
+    LOOKUP_TEMPERATURE_STEP,
+    _check_lookup_engine,
+    _data_path,
+    _estimate_mem_mb,
+    _get_suitability_lookup,
+    _open_climate_data,
+)
+
+# Sensitivity of the epi model results to a systematic temperature bias. Each climate
+# file is read once, and the (lookup engine) epi models are evaluated with the
+# temperature shifted by each offset (in °C), giving yearly portion suitable with an
+# additional "offset" dimension. Offsets are processed SWEEP_OFFSETS_PER_CHUNK at a
+# time, which bounds the memory used for the daily suitability.
+SWEEP_OFFSET_MIN = -2
+SWEEP_OFFSET_MAX = 2
+SWEEP_OFFSET_STEP = 0.25
+SWEEP_OFFSETS_PER_CHUNK = 4
+
+
+def _run_offset_sweep(
+    dataset=None,
+    years=None,
+    realizations=None,
+    epi_model_names=None,
+    offsets=None,
+    offsets_per_chunk=SWEEP_OFFSETS_PER_CHUNK,
+    workers=1,
+):
+    subset_all = DATASETS[dataset]["subset"]
+    if years is None:
+        years = subset_all["years"]
+    if realizations is None:
+        realizations = subset_all["realizations"]
+    if epi_model_names is None:
+        epi_model_names = LOOKUP_EPI_MODEL_NAMES
+    if offsets is None:
+        offsets = _get_offsets()
+    years = np.atleast_1d(years)
+    realizations = np.atleast_1d(realizations)
+    offsets = np.atleast_1d(np.asarray(offsets, dtype=np.float64))
+
+    save_dirs = {
+        epi_model_name: _get_sweep_save_dir(
+            dataset=dataset, epi_model_name=epi_model_name
+        )
+        for epi_model_name in epi_model_names
+    }
+    first_data_path = _data_path(
+        dataset=dataset, realization=realizations[0], year=years[0]
+    )
+    ds_clim_first = _open_climate_data(first_data_path)
+    for epi_model_name in epi_model_names:
+        _check_lookup_engine(ds_clim_first, epi_model_name=epi_model_name)
+
+    print(
+        f"Running {len(offsets)} temperature offsets ({offsets[0]:g} to "
+        f"{offsets[-1]:g} °C) for {', '.join(epi_model_names)}"
+    )
+    run_tasks(
+        functools.partial(
+            _run_offset_sweep_file,
+            dataset=dataset,
+            epi_model_names=epi_model_names,
+            offsets=offsets,
+            offsets_per_chunk=offsets_per_chunk,
+            save_dirs=save_dirs,
+        ),
+        [
+            {"realization": realization, "year": year}
+            for year, realization in itertools.product(years, realizations)
+        ],
+        workers=workers,
+        task_mem_mb=_estimate_mem_mb(
+            first_data_path,
+            overhead_factor=1
+            + min(offsets_per_chunk, len(offsets))
+            * len(epi_model_names)
+            * EPI_MODEL_MEM_OVERHEAD,
+        ),
+    )
+
+
+def _run_offset_sweep_file(
+    *,
+    dataset,
+    realization,
+    year,
+    epi_model_names,
+    offsets,
+    offsets_per_chunk,
+    save_dirs,
+):
+    data_path = _data_path(dataset=dataset, realization=realization, year=year)
+    ds_clim = _open_climate_data(data_path).load()
+    suitability_lookups = [
+        _get_suitability_lookup(epi_model_name) for epi_model_name in epi_model_names
+    ]
+    datasets_chunks = {epi_model_name: [] for epi_model_name in epi_model_names}
+    for start in range(0, len(offsets), offsets_per_chunk):
+        offsets_chunk = offsets[start : start + offsets_per_chunk]
+        suitability_chunks = _lookup_suitability_offsets(
+            ds_clim["temperature"].values,
+            offsets=offsets_chunk,
+            suitability_tables=[values for _, values in suitability_lookups],
+        )
+        for epi_model_name, (var_name, _), suitability in zip(
+            epi_model_names, suitability_lookups, suitability_chunks
+        ):
+            ds_suitability = (
+                ds_clim.drop_vars("temperature")
+                .assign(
+                    {var_name: (("offset", *ds_clim["temperature"].dims), suitability)}
+                )
+                .assign_coords(offset=offsets_chunk)
+            )
+            # Aggregate with climepi so that the output matches EpiModel.run
+            datasets_chunks[epi_model_name].append(
+                ds_suitability.climepi.yearly_portion_suitable().compute()
+            )
+    datasets_out = [
+        xr.concat(
+            datasets_chunks[epi_model_name],
+            dim="offset",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+        ).assign_coords(
+            offset=(
+                "offset",
+                offsets,
+                {"long_name": "Temperature offset", "units": "°C"},
+            )
+        )
+        for epi_model_name in epi_model_names
+    ]
+    save_paths = [
+        save_dirs[epi_model_name] / f"{realization}_{year}.nc"
+        for epi_model_name in epi_model_names
+    ]
+    with atomic_save_paths(save_paths) as tmp_paths:
+        for ds_out, tmp_path in zip(datasets_out, tmp_paths):
+            ds_out.to_netcdf(tmp_path)
+
+
+def _lookup_suitability_offsets(temperature, offsets, suitability_tables):
+    # Suitability for each lookup table at each offset (along a new leading axis). The
+    # nearest lookup grid points are found once per offset and shared between tables,
+    # as in run_epi_model._lookup_suitability.
+    offsets = offsets.reshape((-1,) + (1,) * temperature.ndim)
+    index = np.rint(
+        (temperature[None] + offsets - LOOKUP_TEMPERATURE_MIN) / LOOKUP_TEMPERATURE_STEP
+    )
+    # All tables are on the same temperature grid
+    index = np.clip(np.nan_to_num(index), 0, len(suitability_tables[0]) - 1)
+    index = index.astype(np.int64)
+    is_missing = np.broadcast_to(np.isnan(temperature), index.shape)
+    return [
+        np.where(is_missing, np.nan, suitability_values[index])
+        for suitability_values in suitability_tables
+    ]
+
+
+def _get_offsets(
+    offset_min=SWEEP_OFFSET_MIN,
+    offset_max=SWEEP_OFFSET_MAX,
+    offset_step=SWEEP_OFFSET_STEP,
+):
+    n_offsets = round((offset_max - offset_min) / offset_step) + 1
+    # Rounded so that the offset coordinates are exact multiples of the step
+    return np.round(offset_min + offset_step * np.arange(n_offsets), 10)
+
+
+def _get_sweep_save_dir(dataset, epi_model_name):
+    save_dir = (
+        pathlib.Path(__file__).parents[1]
+        / f"results/offset_sweep/{epi_model_name}/{dataset}"
+    )
+    save_dir.mkdir(parents=True, exist_ok=True)
+    return save_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run epi models with a range of temperature offsets"
+    )
+    parser.add_argument("--dataset", type=str, required=True, help="Dataset name")
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Years to run the epi models for",
+    )
+    parser.add_argument(
+        "--realizations",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Realizations to run the epi models on",
+    )
+    parser.add_argument(
+        "--epi-model-names",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Epi models to run (defaults to all lookup engine models)",
+    )
+    parser.add_argument(
+        "--offset-min",
+        type=float,
+        default=SWEEP_OFFSET_MIN,
+        help="Smallest temperature offset (°C)",
+    )
+    parser.add_argument(
+        "--offset-max",
+        type=float,
+        default=SWEEP_OFFSET_MAX,
+        help="Largest temperature offset (°C)",
+    )
+    parser.add_argument(
+        "--offset-step",
+        type=float,
+        default=SWEEP_OFFSET_STEP,
+        help="Spacing of temperature offsets (°C)",
+    )
+    parser.add_argument(
+        "--offsets-per-chunk",
+        type=int,
+        default=SWEEP_OFFSETS_PER_CHUNK,
+        help="Number of offsets evaluated at once (bounds memory use)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of files to process in parallel (capped to fit in memory)",
+    )
+    args = parser.parse_args()
+    _run_offset_sweep(
+        dataset=args.dataset,
+        years=args.years,
+        realizations=args.realizations,
+        epi_model_names=args.epi_model_names,
+        offsets=_get_offsets(
+            offset_min=args.offset_min,
+            offset_max=args.offset_max,
+            offset_step=args.offset_step,
+        ),
+        offsets_per_chunk=args.offsets_per_chunk,
+        workers=args.workers,
+    )
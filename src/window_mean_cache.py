@@ -0,0 +1,112 @@
+import hashlib
+import json
+import pathlib
+
+import dask
+import xarray as xr
+
+from parallel_utils import atomic_save_paths
+
+# Cache of window sums of epi model results, from which window means over any subset of
+# realizations are formed. For a window (a set of years) the cache holds the sum and
+# count (over the years) of portion_suitable for each realization and grid cell. Sums
+# are memoized in process and saved under results/window_mean_cache, keyed by a
+# fingerprint of the input files (see get_input_key) and the years, so that overlapping
+# comparisons and repeated runs only read each window once.
+
+_MEMORY_CACHE = {}
+
+
+def get_input_key(paths):
+    """Fingerprint of a set of input files, from their paths, sizes and mtimes."""
+    input_hash = hashlib.sha256()
+    for path in sorted(pathlib.Path(path) for path in paths):
+        stat = path.stat()
+        input_hash.update(
+            f"{path.as_posix()}:{stat.st_size}:{stat.st_mtime_ns}\n".encode()
+        )
+    return input_hash.hexdigest()
+
+
+def get_window_sums(windows):
+    """Get window sums for each (ds, years, input_key) in windows.
+
+    ds is either epi model results, or partial reductions from the reduction cache
+    (which have a "file" dimension). Sums are only memoized if input_key is not None.
+    All sums that are not already cached are computed with a single dask.compute.
+    Returns a list of in-memory datasets, with portion_suitable_sum and
+    portion_suitable_count variables and a realization dimension.
+    """
+    results = [None] * len(windows)
+    pending = {}
+    for i, (ds, years, input_key) in enumerate(windows):
+        years = sorted(int(year) for year in years)
+        cache_key = None if input_key is None else _get_cache_key(input_key, years)
+        ds_sums = _load_window_sums(cache_key)
+        if ds_sums is not None:
+            results[i] = ds_sums
+        else:
+            pending[i] = (cache_key, _window_sums(ds, years))
+    if pending:
+        print(f"Computing {len(pending)} window sums...")
+        computed = dask.compute(*(ds_sums for _, ds_sums in pending.values()))
+        for (i, (cache_key, _)), ds_sums in zip(pending.items(), computed):
+            _save_window_sums(cache_key, ds_sums)
+            results[i] = ds_sums
+    return results
+
+
+def _window_sums(ds, years):
+    if "file" in ds.dims:
+        ds_window = ds.isel(file=ds.year.isin(years).values)
+        ds_sums = (
+            ds_window[["portion_suitable_sum", "portion_suitable_count"]]
+            .groupby("realization")
+            .sum()
+        )
+    else:
+        da_window = ds["portion_suitable"].sel(time=ds.time.dt.year.isin(years))
+        ds_sums = xr.Dataset(
+            {
+                "portion_suitable_sum": da_window.sum(dim="time"),
+                "portion_suitable_count": da_window.count(dim="time"),
+            }
+        )
+    # Drop any length-one dimensions (e.g. scenario), keeping realization
+    squeeze_dims = [
+        dim for dim, size in ds_sums.sizes.items() if size == 1 and dim != "realization"
+    ]
+    ds_sums = ds_sums.squeeze(squeeze_dims, drop=True)
+    return ds_sums.reset_coords(drop=True)
+
+
+def _load_window_sums(cache_key):
+    if cache_key is None:
+        return None
+    if cache_key not in _MEMORY_CACHE:
+        cache_path = _get_cache_path(cache_key)
+        if not cache_path.exists():
+            return None
+        with xr.open_dataset(cache_path) as ds:
+            _MEMORY_CACHE[cache_key] = ds.load()
+    return _MEMORY_CACHE[cache_key]
+
+
+def _save_window_sums(cache_key, ds_sums):
+    if cache_key is None:
+        return
+    _MEMORY_CACHE[cache_key] = ds_sums
+    with atomic_save_paths([_get_cache_path(cache_key)], shared_cache=True) as (
+        tmp_path,
+    ):
+        ds_sums.to_netcdf(tmp_path)
+
+
+def _get_cache_key(input_key, years):
+    return hashlib.sha256(json.dumps([input_key, years]).encode()).hexdigest()
+
+
+def _get_cache_path(cache_key):
+    cache_dir = pathlib.Path(__file__).parents[1] / "results/window_mean_cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / f"{cache_key}.nc"